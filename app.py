@@ -7,14 +7,47 @@ DataCulture Unified Platform
 import streamlit as st
 import pandas as pd
 import numpy as np
-from datetime import datetime
+from datetime import datetime, date
 import io
 import json
+import pickle
+import time
+import random
+import heapq
+import functools
 from openai import OpenAI
 import tempfile
 import os
-from typing import Dict, Tuple
+import hashlib
+import sqlite3
+import zipfile
+import queue
+import threading
+import multiprocessing
+import importlib.machinery
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, CancelledError, FIRST_COMPLETED, as_completed, wait
+from concurrent.futures.process import BrokenProcessPool
+from typing import Dict, List, Optional, Tuple
 from supabase import create_client, Client
+from postgrest.exceptions import APIError
+import httpx
+import xlsxwriter
+
+from processing import (
+    DEFAULT_GRADE_RULES,
+    extract_course_worker,
+    load_grade_rules,
+    parse_table_bytes,
+    process_grade_recalculation,
+    recalculate_grade_file
+)
+
+try:
+    import pyarrow  # noqa: F401 — нужен pandas для экспорта в Parquet
+    PARQUET_AVAILABLE = True
+except ImportError:
+    PARQUET_AVAILABLE = False
 
 # =============================================================================
 # КОНФИГУРАЦИЯ ПРИЛОЖЕНИЯ
@@ -402,112 +435,559 @@ SYSTEM_MESSAGE = (
 )
 
 # =============================================================================
-# ФУНКЦИИ ДЛЯ МОДУЛЯ 1: ПЕРЕЗАЧЕТ ОЦЕНОК
+# ОБЩИЕ ВСПОМОГАТЕЛЬНЫЕ ФУНКЦИИ
 # =============================================================================
 
-def process_grade_recalculation(df: pd.DataFrame, use_dynamics: bool) -> pd.DataFrame:
+def _st_report(level: str, message: str):
+    """Вывод сообщения в интерфейс: level — имя функции Streamlit (info, success, warning, error)"""
+    getattr(st, level)(message)
+
+# Верхняя граница числа процессов-воркеров: каждый держит в памяти разбираемый файл (контейнер — 2 ГБ)
+PROCESS_POOL_MAX_WORKERS = 4
+
+def _process_pool_size() -> int:
+    """Число доступных процессу CPU, ограниченное PROCESS_POOL_MAX_WORKERS"""
+    try:
+        cpu_count = len(os.sched_getaffinity(0))
+    except AttributeError:
+        cpu_count = os.cpu_count() or 1
+    return max(1, min(cpu_count, PROCESS_POOL_MAX_WORKERS))
+
+if __name__ == "__main__":
+    # Streamlit выполняет скрипт в модуле __main__ с __file__ = app.py, и multiprocessing
+    # запустил бы app.py целиком в каждом воркере. Спецификация с именем "__main__"
+    # отключает этот шаг: воркеры импортируют только processing.py
+    __spec__ = importlib.machinery.ModuleSpec('__main__', None)
+
+@st.cache_resource
+def get_process_pool() -> Optional[ProcessPoolExecutor]:
     """
-    Обработка данных для перезачета оценок
+    Общий пул процессов-воркеров (один на процесс сервера)
+    
+    Воркеры запускаются через forkserver (или spawn): fork многопоточного
+    сервера Streamlit может унаследовать захваченные другими потоками блокировки.
+    Воркеры импортируют только processing.py (forkserver загружает его заранее),
+    app.py и Streamlit в них не выполняются. Процессы переиспользуются между
+    запусками скрипта.
+    
+    Returns:
+        ProcessPoolExecutor или None, если процессу доступен один CPU
+    """
+    workers = _process_pool_size()
+    if workers < 2:
+        return None
+    start_method = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+    mp_context = multiprocessing.get_context(start_method)
+    if start_method == 'forkserver':
+        # pandas и функции воркеров импортируются один раз в процессе forkserver
+        mp_context.set_forkserver_preload(['processing'])
+    return ProcessPoolExecutor(max_workers=workers, mp_context=mp_context)
+
+def _discard_process_pool(executor: ProcessPoolExecutor):
+    """Сброс сломанного пула: следующий запуск создаст новый"""
+    get_process_pool.clear()
+    executor.shutdown(wait=False, cancel_futures=True)
+
+def run_in_process_pool(func, tasks: list):
+    """
+    Параллельный запуск функции в общем пуле процессов
+    
+    Результаты отдаются по мере готовности. Задачи, которые не удалось передать
+    в пул (один CPU, сломался воркер, ошибка сериализации pickle), выполняются
+    в текущем процессе.
     
     Args:
-        df: DataFrame с данными студентов
-        use_dynamics: Учитывать ли динамику оценок
+        func: Функция из модуля processing (сериализуется pickle по имени модуля)
+        tasks: Список кортежей аргументов для func
         
-    Returns:
-        Обработанный DataFrame с колонками ДПР_итог и НЭ_итог
+    Yields:
+        Tuple (индекс задачи, результат или None, исключение или None)
     """
-    processed_df = df.copy()
+    pending = set(range(len(tasks)))
+    executor = get_process_pool() if len(tasks) > 1 else None
+    
+    if executor is not None:
+        pool_broken = False
+        try:
+            futures = {executor.submit(func, *tasks[idx]): idx for idx in sorted(pending)}
+            for future in as_completed(futures):
+                idx = futures[future]
+                try:
+                    result = future.result()
+                except BrokenProcessPool:
+                    pool_broken = True
+                    continue
+                except (pickle.PicklingError, CancelledError):
+                    continue
+                except Exception as e:
+                    pending.discard(idx)
+                    yield idx, None, e
+                    continue
+                pending.discard(idx)
+                yield idx, result, None
+        except (RuntimeError, OSError):
+            # submit в сломанный или остановленный пул
+            pool_broken = True
+        if pool_broken:
+            _discard_process_pool(executor)
+    
+    for idx in sorted(pending):
+        try:
+            yield idx, func(*tasks[idx]), None
+        except Exception as e:
+            yield idx, None, e
 
-    required_columns = [
-        'Наименование НЭ', 'Оценка НЭ', 'Оценка дисциплины-пререквизита',
-        'Внешнее измерение цифровых компетенций. Входной контроль',
-        'Внешнее измерение цифровых компетенций. Промежуточный контроль',
-        'Внешнее измерение цифровых компетенций. Итоговый контроль'
-    ]
+def _usecols_cache_key(usecols):
+    """Хэшируемое представление набора колонок для ключа кэша"""
+    if usecols is None:
+        return None
+    if callable(usecols):
+        return f"{usecols.__module__}.{usecols.__qualname__}"
+    return tuple(usecols)
+
+# Ограничения кэша разобранных загрузок (общий для всех сессий процесса).
+# Попадание возвращает копию DataFrame, поэтому в памяти одновременно находятся кэш
+# и копии активных сессий — лимит выбран с запасом для контейнера на 2 ГБ
+UPLOAD_CACHE_MAX_BYTES = 128 * 1024 * 1024
+UPLOAD_CACHE_MAX_ENTRIES = 32
+
+class ParsedUploadCache:
+    """
+    LRU-кэш разобранных загрузок с ограничением по памяти
     
-    for col in required_columns:
-        if col not in processed_df.columns:
-            raise KeyError(f"Отсутствует обязательный столбец: '{col}'")
+    Ключ включает SHA-256 содержимого файла, поэтому повторный запуск скрипта
+    Streamlit с тем же файлом не разбирает его заново. При превышении лимита
+    вытесняются давно не использованные записи. Для каждой записи хранится
+    набор сессий, которые ее использовали: очистка из сессии удаляет только
+    записи, не нужные другим сессиям.
+    """
 
-    processed_df['Оценка дисциплины-пререквизита'] = processed_df['Оценка дисциплины-пререквизита'].apply(
-        lambda x: 8 if x >= 9 else x
-    )
+    def __init__(self, max_bytes: int, max_entries: int):
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._content_hashes = OrderedDict()
+        self._lock = threading.Lock()
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def content_hash(self, uploaded_file) -> str:
+        """SHA-256 содержимого загрузки (запоминается по file_id, если он есть)"""
+        file_id = getattr(uploaded_file, 'file_id', None)
+        with self._lock:
+            if file_id is not None and file_id in self._content_hashes:
+                return self._content_hashes[file_id]
+        content_hash = hashlib.sha256(uploaded_file.getvalue()).hexdigest()
+        if file_id is not None:
+            with self._lock:
+                self._content_hashes[file_id] = content_hash
+                while len(self._content_hashes) > self.max_entries * 4:
+                    self._content_hashes.popitem(last=False)
+        return content_hash
+
+    def get(self, key: tuple, owner: str = None) -> Optional[pd.DataFrame]:
+        """
+        Копия закэшированного DataFrame или None, если записи нет
+        
+        Args:
+            key: Ключ записи (тип разбора, хэш содержимого, параметры)
+            owner: Идентификатор сессии, использующей запись
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            entry[2].add(owner)
+            self.hits += 1
+            return entry[0].copy()
+
+    def put(self, key: tuple, df: pd.DataFrame, owner: str = None):
+        """
+        Сохранение DataFrame (вызывающий код не должен изменять его после сохранения)
+        
+        Args:
+            key: Ключ записи
+            df: Результат разбора (больше max_bytes не сохраняется)
+            owner: Идентификатор сессии, использующей запись
+        """
+        size = int(df.memory_usage(index=True, deep=True).sum())
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                return
+            self._entries[key] = (df, size, {owner})
+            self.current_bytes += size
+            while self._entries and (self.current_bytes > self.max_bytes or len(self._entries) > self.max_entries):
+                _, (_, evicted_size, _) = self._entries.popitem(last=False)
+                self.current_bytes -= evicted_size
+                self.evictions += 1
+
+    def get_or_parse(self, key: tuple, parse_fn, owner: str = None) -> pd.DataFrame:
+        """
+        Возвращает копию закэшированного DataFrame или разбирает файл
+        
+        Args:
+            key: Ключ записи (тип разбора, хэш содержимого, параметры)
+            parse_fn: Функция без аргументов, выполняющая разбор
+            owner: Идентификатор сессии, использующей запись
+            
+        Returns:
+            Копия DataFrame (вызывающий код может его изменять)
+        """
+        df = self.get(key, owner)
+        if df is not None:
+            return df
+        df = parse_fn()
+        self.put(key, df, owner)
+        return df.copy()
+
+    def stats(self, owner: str = None) -> Dict[str, int]:
+        """Метрики кэша: записи (всего и сессии owner), объем, попадания, промахи, вытеснения"""
+        with self._lock:
+            return {
+                'entries': len(self._entries),
+                'owner_entries': sum(1 for _, _, owners in self._entries.values() if owner in owners),
+                'bytes': self.current_bytes,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions
+            }
 
-    processed_df['Этап'] = 1
-    processed_df.loc[processed_df['Наименование НЭ'].str.contains('анализу данных', case=False, na=False), 'Этап'] = 3
-    processed_df.loc[processed_df['Наименование НЭ'].str.contains('программированию', case=False, na=False), 'Этап'] = 2
+    def clear(self, owner: str = None):
+        """
+        Очистка кэша (метрики сохраняются)
+        
+        Args:
+            owner: Сессия, записи которой нужно сбросить (None — весь кэш).
+                Записи, которые используют и другие сессии, остаются в кэше.
+        """
+        with self._lock:
+            if owner is None:
+                self._entries.clear()
+                self.current_bytes = 0
+                return
+            for key in list(self._entries):
+                df, size, owners = self._entries[key]
+                owners.discard(owner)
+                if not owners:
+                    del self._entries[key]
+                    self.current_bytes -= size
 
-    dpr_results = []
-    ie_results = []
+@st.cache_resource
+def get_upload_cache() -> ParsedUploadCache:
+    """Общий для всех сессий кэш разобранных загрузок"""
+    return ParsedUploadCache(UPLOAD_CACHE_MAX_BYTES, UPLOAD_CACHE_MAX_ENTRIES)
 
-    for index, row in processed_df.iterrows():
-        if row['Этап'] == 1:
-            innopolis_grade = row['Внешнее измерение цифровых компетенций. Входной контроль']
-        elif row['Этап'] == 2:
-            innopolis_grade = row['Внешнее измерение цифровых компетенций. Промежуточный контроль']
-        else:
-            innopolis_grade = row['Внешнее измерение цифровых компетенций. Итоговый контроль']
+def upload_cache_owner() -> str:
+    """Идентификатор текущей сессии: владелец записей кэша загрузок и область журнала загрузки"""
+    if 'upload_cache_owner' not in st.session_state:
+        st.session_state['upload_cache_owner'] = os.urandom(16).hex()
+    return st.session_state['upload_cache_owner']
 
-        if use_dynamics:
-            vhod = row['Внешнее измерение цифровых компетенций. Входной контроль']
-            prom = row['Внешнее измерение цифровых компетенций. Промежуточный контроль']
-            itog = row['Внешнее измерение цифровых компетенций. Итоговый контроль']
+def upload_cache_key(kind: str, uploaded_file, *params) -> tuple:
+    """
+    Ключ записи кэша загрузок
+    
+    Args:
+        kind: Тип разбора (например, 'table' или 'course')
+        uploaded_file: Загруженный файл Streamlit
+        *params: Параметры разбора, влияющие на результат
+    """
+    # Расширение входит в ключ: одинаковые байты могут быть загружены как .csv и .xlsx
+    extension = os.path.splitext(uploaded_file.name.lower())[1]
+    return (kind, get_upload_cache().content_hash(uploaded_file), extension) + tuple(params)
+
+def cached_upload_parse(kind: str, uploaded_file, parse_fn, *params) -> pd.DataFrame:
+    """
+    Разбор загрузки через общий кэш
+    
+    Args:
+        kind: Тип разбора (например, 'table' или 'student_list')
+        uploaded_file: Загруженный файл Streamlit
+        parse_fn: Функция без аргументов, выполняющая разбор
+        *params: Параметры разбора, влияющие на результат (входят в ключ)
+        
+    Returns:
+        DataFrame с результатом разбора
+    """
+    key = upload_cache_key(kind, uploaded_file, *params)
+    return get_upload_cache().get_or_parse(key, parse_fn, upload_cache_owner())
+
+def read_uploaded_table(uploaded_file, usecols=None, detect_encoding: bool = True) -> pd.DataFrame:
+    """
+    Чтение загруженного файла с кэшированием по хэшу содержимого
+    
+    Повторные запуски скрипта Streamlit (клики по виджетам) не разбирают
+    тот же файл заново.
+    
+    Args:
+        uploaded_file: Загруженный файл Streamlit
+        usecols: Список нужных колонок или функция-фильтр по имени колонки (None — все)
+        detect_encoding: Подбирать ли кодировку CSV (иначе читается как UTF-8)
+        
+    Returns:
+        DataFrame с данными файла
+    """
+    return cached_upload_parse(
+        'table', uploaded_file,
+        lambda: parse_table_bytes(uploaded_file.getvalue(), uploaded_file.name, usecols, detect_encoding),
+        _usecols_cache_key(usecols), detect_encoding
+    )
+
+# Форматы выгрузки: расширение -> (подпись, MIME-тип)
+EXPORT_FORMATS = {
+    'xlsx': ('XLSX', 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'),
+    'csv': ('CSV', 'text/csv'),
+    'parquet': ('Parquet', 'application/vnd.apache.parquet')
+}
+
+# Выгрузки до этого размера собираются в памяти, большие — во временном файле на диске
+EXPORT_SPOOL_MAX_SIZE = 32 * 1024 * 1024
+
+EXCEL_MAX_ROWS = 1048576
+
+# Размер порции строк при записи XLSX
+EXCEL_WRITE_CHUNK_ROWS = 10000
+
+_EXCEL_NATIVE_TYPES = (str, bool, int, float, datetime, date)
+
+def _excel_column_values(series: pd.Series) -> list:
+    """Значения колонки в виде, пригодном для xlsxwriter (пропуски -> None)"""
+    if isinstance(series.dtype, pd.DatetimeTZDtype):
+        series = series.dt.tz_localize(None)
+    values = series.astype(object).where(series.notna(), None).tolist()
+    if series.dtype == object or isinstance(series.dtype, pd.CategoricalDtype):
+        values = [
+            value if value is None or isinstance(value, _EXCEL_NATIVE_TYPES)
+            else value.item() if isinstance(value, np.generic) else str(value)
+            for value in values
+        ]
+    return values
+
+def write_excel_sheets(sheets: Dict[str, pd.DataFrame]) -> bytes:
+    """
+    Потоковая запись листов в XLSX через xlsxwriter в режиме constant_memory
+    
+    Строки пишутся по очереди и сразу сбрасываются на диск, поэтому память
+    не растет вместе с размером выгрузки, а готовый файл собирается во
+    временном файле (в памяти — только пока он небольшой).
+    
+    Args:
+        sheets: Словарь {название листа: DataFrame}
+        
+    Returns:
+        Содержимое XLSX-файла
+    """
+    with tempfile.SpooledTemporaryFile(max_size=EXPORT_SPOOL_MAX_SIZE) as spool:
+        workbook = xlsxwriter.Workbook(spool, {
+            'constant_memory': True,
+            'strings_to_formulas': False,
+            'strings_to_urls': False,
+            'nan_inf_to_errors': True,
+            'remove_timezone': True
+        })
+        header_format = workbook.add_format({'bold': True, 'border': 1, 'align': 'center', 'valign': 'top'})
+        date_format = workbook.add_format({'num_format': 'dd.mm.yyyy hh:mm:ss'})
+        
+        for sheet_name, df in sheets.items():
+            if len(df) + 1 > EXCEL_MAX_ROWS:
+                workbook.close()
+                raise ValueError(f"Лист '{sheet_name}' слишком большой для Excel ({len(df)} строк). Используйте CSV или Parquet.")
+            
+            worksheet = workbook.add_worksheet(str(sheet_name)[:31])
+            worksheet.write_row(0, 0, [str(col) for col in df.columns], header_format)
             
-            if (vhod - prom > 1) or (vhod - itog > 1) or (prom - itog > 1):
-                dpr_results.append(np.nan)
-                ie_results.append(np.nan)
-                continue
-
-        ne_grade = row['Оценка НЭ']
-        dpr_grade = row['Оценка дисциплины-пререквизита']
-        
-        ne_grade = 0 if pd.isna(ne_grade) else ne_grade
-        dpr_grade = 0 if pd.isna(dpr_grade) else dpr_grade
-        innopolis_grade = 0 if pd.isna(innopolis_grade) else innopolis_grade
-
-        max_grade = max(ne_grade, dpr_grade, innopolis_grade)
-        
-        # Расчет ДПР_итог
-        dpr_final = np.nan
-        if ne_grade < 4:
-            dpr_final = np.nan
-        elif max_grade == innopolis_grade and innopolis_grade > 3 and innopolis_grade != dpr_grade and innopolis_grade != ne_grade:
-            dpr_final = innopolis_grade
-        elif ne_grade == dpr_grade:
-            dpr_final = np.nan
-        elif dpr_grade < 4:
-            dpr_final = ne_grade if ne_grade >= 4 else np.nan
-        elif max_grade == dpr_grade and dpr_grade >= 4:
-            dpr_final = np.nan
+            # Для типизированных колонок пишем напрямую, минуя разбор типа в worksheet.write
+            writers = []
+            for idx in range(df.shape[1]):
+                dtype = df.iloc[:, idx].dtype
+                if pd.api.types.is_datetime64_any_dtype(dtype):
+                    writers.append((worksheet.write_datetime, date_format))
+                elif pd.api.types.is_bool_dtype(dtype):
+                    writers.append((worksheet.write_boolean, None))
+                elif pd.api.types.is_numeric_dtype(dtype):
+                    writers.append((worksheet.write_number, None))
+                else:
+                    writers.append((worksheet.write, None))
+            
+            # Значения переводятся в объекты Python порциями, а не целыми колонками
+            for chunk_start in range(0, len(df), EXCEL_WRITE_CHUNK_ROWS):
+                chunk = df.iloc[chunk_start:chunk_start + EXCEL_WRITE_CHUNK_ROWS]
+                columns = [_excel_column_values(chunk.iloc[:, idx]) for idx in range(chunk.shape[1])]
+                for row_idx, row in enumerate(zip(*columns), start=chunk_start + 1):
+                    for col_idx, value in enumerate(row):
+                        if value is not None:
+                            write_cell, cell_format = writers[col_idx]
+                            write_cell(row_idx, col_idx, value, cell_format)
+        
+        workbook.close()
+        spool.seek(0)
+        return spool.read()
+
+def export_dataframe(df: pd.DataFrame, export_format: str = 'xlsx', sheet_name: str = 'Sheet1') -> bytes:
+    """
+    Выгрузка DataFrame в XLSX, CSV или Parquet
+    
+    Args:
+        df: DataFrame для выгрузки
+        export_format: Формат из EXPORT_FORMATS
+        sheet_name: Название листа для XLSX
+        
+    Returns:
+        Содержимое файла
+    """
+    if export_format == 'xlsx':
+        return write_excel_sheets({sheet_name: df})
+    
+    with tempfile.SpooledTemporaryFile(max_size=EXPORT_SPOOL_MAX_SIZE) as spool:
+        if export_format == 'csv':
+            # utf-8-sig — чтобы Excel корректно открывал кириллицу
+            df.to_csv(spool, index=False, encoding='utf-8-sig')
+        elif export_format == 'parquet':
+            if not PARQUET_AVAILABLE:
+                raise ValueError("Для выгрузки в Parquet установите пакет pyarrow")
+            try:
+                df.to_parquet(spool, index=False)
+            except Exception:
+                # Колонки со смешанными типами значений сохраняем как строки
+                spool.seek(0)
+                spool.truncate()
+                object_columns = {col: 'string' for col in df.columns if df[col].dtype == object}
+                df.astype(object_columns).to_parquet(spool, index=False)
         else:
-            dpr_final = ne_grade
-        dpr_results.append(dpr_final)
-
-        # Расчет НЭ_итог
-        ie_final = np.nan
-        if ne_grade < 4:
-            ie_final = np.nan
-        elif max_grade == innopolis_grade and innopolis_grade > 3 and innopolis_grade != dpr_grade and innopolis_grade != ne_grade:
-            ie_final = innopolis_grade
-        elif ne_grade == dpr_grade:
-            ie_final = np.nan
-        elif max_grade == dpr_grade and dpr_grade >= 4:
-            if ne_grade >= 8:
-                ie_final = np.nan
-            elif dpr_grade >= 8:
-                ie_final = 8
-            else:
-                ie_final = dpr_grade
-        elif ne_grade < 4 and innopolis_grade > 3 and use_dynamics:
-             ie_final = innopolis_grade
+            raise ValueError(f"Неподдерживаемый формат выгрузки: {export_format}")
+        spool.seek(0)
+        return spool.read()
+
+def available_export_formats() -> List[str]:
+    """Форматы выгрузки, доступные в текущем окружении"""
+    return [fmt for fmt in EXPORT_FORMATS if fmt != 'parquet' or PARQUET_AVAILABLE]
+
+def render_download_button(sheets: Dict[str, pd.DataFrame], file_stem: str, label: str, key: str):
+    """
+    Кнопка скачивания результата в формате, выбранном в боковой панели
+    
+    Файл собирается только в выбранном формате. XLSX содержит все листы,
+    CSV и Parquet — только первый (основной) лист.
+    
+    Args:
+        sheets: Словарь {название листа: DataFrame}
+        file_stem: Имя файла без расширения
+        label: Подпись кнопки
+        key: Префикс ключа виджета
+    """
+    export_format = st.session_state.get('export_format', 'xlsx')
+    if export_format not in available_export_formats():
+        export_format = 'xlsx'
+    format_label, mime = EXPORT_FORMATS[export_format]
+    
+    try:
+        if export_format == 'xlsx':
+            data = write_excel_sheets(sheets)
         else:
-            ie_final = np.nan
-        ie_results.append(ie_final)
+            main_sheet_name, main_df = next(iter(sheets.items()))
+            data = export_dataframe(main_df, export_format, main_sheet_name)
+    except ValueError as e:
+        st.error(f"❌ {e} Формат выгрузки выбирается в боковой панели.")
+        return
+    
+    st.download_button(
+        label=f"{label} ({format_label})",
+        data=data,
+        file_name=f"{file_stem}.{export_format}",
+        mime=mime,
+        key=f"{key}_{export_format}",
+        use_container_width=True
+    )
+
+# =============================================================================
+# ФУНКЦИИ ДЛЯ МОДУЛЯ 1: ПЕРЕЗАЧЕТ ОЦЕНОК
+# =============================================================================
+
+GRADE_BATCH_EXTENSIONS = ('.xlsx', '.csv')
+
+def expand_batch_uploads(uploaded_files) -> List[Tuple[str, bytes]]:
+    """
+    Собирает список файлов для пакетного перезачета, распаковывая ZIP-архивы
+    
+    Args:
+        uploaded_files: Загруженные файлы (Excel, CSV или ZIP)
+        
+    Returns:
+        Список кортежей (имя файла, содержимое)
+    """
+    files = []
+    for uploaded_file in uploaded_files:
+        content = uploaded_file.getvalue()
+        if not uploaded_file.name.lower().endswith('.zip'):
+            files.append((uploaded_file.name, content))
+            continue
+        
+        with zipfile.ZipFile(io.BytesIO(content)) as archive:
+            for info in archive.infolist():
+                name = info.filename
+                # Архивы из Windows без флага UTF-8 хранят кириллицу в cp866
+                if not info.flag_bits & 0x800:
+                    name = name.encode('cp437').decode('cp866', errors='replace')
+                base_name = os.path.basename(name)
+                if info.is_dir() or name.startswith('__MACOSX/') or base_name.startswith(('.', '~$')):
+                    continue
+                if base_name.lower().endswith(GRADE_BATCH_EXTENSIONS):
+                    files.append((base_name, archive.read(info)))
+    return files
 
-    processed_df['ДПР_итог'] = dpr_results
-    processed_df['НЭ_итог'] = ie_results
+def process_grade_recalculation_batch(files: List[Tuple[str, bytes]], use_dynamics: bool,
+                                      rules: dict = None, progress_callback=None) -> Tuple[pd.DataFrame, pd.DataFrame]:
+    """
+    Пакетный перезачет оценок по нескольким файлам в параллельных процессах
+    
+    Args:
+        files: Список кортежей (имя файла, содержимое)
+        use_dynamics: Учитывать ли динамику оценок
+        rules: Таблица правил перезачета (None — правила по умолчанию)
+        progress_callback: Функция (готово, всего), вызываемая после каждого файла
+        
+    Returns:
+        Tuple (объединённый DataFrame с колонкой "Файл", сводка по файлам)
+    """
+    tasks = [(file_name, content, use_dynamics, rules) for file_name, content in files]
+    results = [None] * len(files)
+    summary = [None] * len(files)
+    
+    for done, (idx, result_df, error) in enumerate(run_in_process_pool(recalculate_grade_file, tasks), start=1):
+        file_name = files[idx][0]
+        if error is not None:
+            summary[idx] = {
+                'Файл': file_name,
+                'Статус': 'Ошибка',
+                'Строк': 0,
+                'ДПР_итог заполнено': 0,
+                'НЭ_итог заполнено': 0,
+                'Комментарий': error.args[0] if isinstance(error, KeyError) and error.args else str(error)
+            }
+        else:
+            result_df.insert(0, 'Файл', file_name)
+            results[idx] = result_df
+            summary[idx] = {
+                'Файл': file_name,
+                'Статус': 'Обработан',
+                'Строк': len(result_df),
+                'ДПР_итог заполнено': int(result_df['ДПР_итог'].notna().sum()) if 'ДПР_итог' in result_df.columns else 0,
+                'НЭ_итог заполнено': int(result_df['НЭ_итог'].notna().sum()) if 'НЭ_итог' in result_df.columns else 0,
+                'Комментарий': ''
+            }
+        if progress_callback:
+            progress_callback(done, len(files))
     
-    return processed_df
+    processed = [df for df in results if df is not None]
+    combined_df = pd.concat(processed, ignore_index=True, sort=False) if processed else pd.DataFrame()
+    return combined_df, pd.DataFrame(summary)
 
 # =============================================================================
 # ФУНКЦИИ ДЛЯ МОДУЛЯ 2: ГЕНЕРАТОР HTML-КАРТОЧЕК
@@ -584,28 +1064,23 @@ def deduplicate_lines(text):
     
     return '\n'.join(unique_lines)
 
+SKILLS_REFERENCE_COLUMNS = ['Дисциплина', 'Уровень_оценки', 'Описание_навыков']
+
 @st.cache_data
 def load_reference_data(skills_content: bytes) -> Dict[str, str]:
     """Загрузка справочных данных из файла навыков"""
-    with tempfile.NamedTemporaryFile(delete=False, suffix='.xlsx') as tmp_file:
-        tmp_file.write(skills_content)
-        tmp_file_path = tmp_file.name
+    skills_df = parse_table_bytes(skills_content, 'skills.xlsx', usecols=SKILLS_REFERENCE_COLUMNS)
     
-    try:
-        skills_df = pd.read_excel(tmp_file_path)
-        
-        grade_mapping = {}
-        for _, row in skills_df.iterrows():
-            discipline = row['Дисциплина']
-            level = row['Уровень_оценки']
-            description = row['Описание_навыков']
-            clean_description = deduplicate_lines(description)
-            composite_key = f"{discipline}—{level}"
-            grade_mapping[composite_key] = clean_description
-        
-        return grade_mapping
-    finally:
-        os.unlink(tmp_file_path)
+    grade_mapping = {}
+    for _, row in skills_df.iterrows():
+        discipline = row['Дисциплина']
+        level = row['Уровень_оценки']
+        description = row['Описание_навыков']
+        clean_description = deduplicate_lines(description)
+        composite_key = f"{discipline}—{level}"
+        grade_mapping[composite_key] = clean_description
+    
+    return grade_mapping
 
 # =============================================================================
 # ФУНКЦИИ ДЛЯ МОДУЛЯ 4: ОБРАБОТКА ПЕРЕСДАЧ ВНЕШНЕЙ ОЦЕНКИ
@@ -618,60 +1093,571 @@ def get_supabase_client() -> Client:
         raise ValueError("Supabase URL и KEY не найдены в secrets.toml")
     return create_client(st.secrets["url"], st.secrets["key"])
 
-def load_students_from_supabase() -> pd.DataFrame:
+# Параметры повторов записи в Supabase
+SUPABASE_RETRY_MAX_ATTEMPTS = 5
+SUPABASE_RETRY_BASE_DELAY = 0.5
+SUPABASE_RETRY_MAX_DELAY = 20.0
+# Бюджет повторов операции: минимум плюс столько повторов на каждый запрос
+SUPABASE_RETRY_BUDGET_MIN = 10
+SUPABASE_RETRY_BUDGET_PER_REQUEST = 2
+SUPABASE_RETRYABLE_HTTP_STATUSES = {408, 425, 429, 500, 502, 503, 504}
+# Коды PostgREST/PostgreSQL: нет соединения с БД, таймаут пула, конфликт сериализации,
+# deadlock, отмена по statement_timeout, переполнение соединений
+SUPABASE_RETRYABLE_PG_CODES = {
+    'PGRST000', 'PGRST001', 'PGRST002', 'PGRST003',
+    '40001', '40P01', '57014', '53300', '08000', '08003', '08006',
+}
+# Ошибки, при которых запрос гарантированно не был применен — их можно повторять и для insert
+SUPABASE_NOT_APPLIED_PG_CODES = {'PGRST000', 'PGRST001', 'PGRST003', '40001', '40P01', '53300'}
+SUPABASE_NOT_APPLIED_HTTP_STATUSES = {429}
+SUPABASE_TRANSIENT_ERROR_PATTERNS = ("connection", "timeout", "ssl", "eof")
+
+def _supabase_error_status(error: Exception):
+    """HTTP-статус или код PostgREST из исключения (None, если его нет)"""
+    if isinstance(error, httpx.HTTPStatusError):
+        return error.response.status_code
+    if isinstance(error, APIError):
+        code = error.code
+        if isinstance(code, int) or (isinstance(code, str) and code.isdigit() and len(code) == 3):
+            return int(code)
+        return code
+    return None
+
+def is_retryable_supabase_error(error: Exception, idempotent: bool = True) -> bool:
+    """
+    Классификация ошибки записи в Supabase
+    
+    Args:
+        error: Исключение запроса
+        idempotent: Запрос можно безопасно повторить (upsert); для insert
+            повторяются только ошибки, при которых запрос точно не был применен
+        
+    Returns:
+        True, если запрос имеет смысл повторить
+    """
+    if isinstance(error, (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout)):
+        return True
+    status = _supabase_error_status(error)
+    if not idempotent:
+        return status in SUPABASE_NOT_APPLIED_PG_CODES or status in SUPABASE_NOT_APPLIED_HTTP_STATUSES
+    if isinstance(error, httpx.TransportError):
+        return True
+    if status is not None:
+        return status in SUPABASE_RETRYABLE_HTTP_STATUSES or status in SUPABASE_RETRYABLE_PG_CODES
+    error_str = str(error).lower()
+    return any(pattern in error_str for pattern in SUPABASE_TRANSIENT_ERROR_PATTERNS)
+
+def supabase_retry_delay(attempt: int, base_delay: float = SUPABASE_RETRY_BASE_DELAY,
+                         max_delay: float = SUPABASE_RETRY_MAX_DELAY) -> float:
+    """Задержка перед повтором: экспоненциальный рост с полным джиттером"""
+    return random.uniform(0, min(max_delay, base_delay * (2 ** (attempt - 1))))
+
+class RetryBudget:
+    """
+    Общий на операцию лимит повторов
+    
+    Не дает массовому сбою превратиться в лавину повторов: когда бюджет исчерпан,
+    ошибка возвращается сразу.
+    """
+    
+    def __init__(self, max_retries: int):
+        self.remaining = max_retries
+        self._lock = threading.Lock()
+    
+    def add(self, retries: int):
+        """Увеличить бюджет (при добавлении запросов в операцию)"""
+        with self._lock:
+            self.remaining += retries
+    
+    def try_acquire(self) -> bool:
+        with self._lock:
+            if self.remaining <= 0:
+                return False
+            self.remaining -= 1
+            return True
+
+class ScheduledRetryPool:
+    """
+    Пул потоков для запросов к Supabase с повторами по расписанию
+    
+    Запрос с повторяемой ошибкой откладывается в очередь с экспоненциальной задержкой
+    и джиттером, не занимая рабочий поток, — остальные запросы продолжают выполняться.
+    Результаты и повторы обрабатываются в потоке, который перебирает run(), поэтому
+    из on_retry и цикла по результатам можно вызывать Streamlit.
+    
+    Бюджет повторов складывается из SUPABASE_RETRY_BUDGET_MIN и
+    SUPABASE_RETRY_BUDGET_PER_REQUEST на каждый добавленный запрос.
+    """
+    
+    def __init__(self, max_in_flight: int, idempotent: bool = True, on_retry=None):
+        """
+        Args:
+            max_in_flight: Максимальное число одновременных запросов
+            idempotent: Запросы можно безопасно повторить
+            on_retry: Функция (tag, номер попытки, ошибка, задержка), вызываемая при откладывании повтора
+        """
+        self.max_in_flight = max(1, max_in_flight)
+        self.idempotent = idempotent
+        self.on_retry = on_retry
+        self.budget = RetryBudget(SUPABASE_RETRY_BUDGET_MIN)
+        # Очередь: (время готовности, порядковый номер, tag, запрос, номер попытки)
+        self._queue = []
+        self._sequence = 0
+    
+    def _push(self, ready_time: float, tag, request_fn, attempt: int):
+        heapq.heappush(self._queue, (ready_time, self._sequence, tag, request_fn, attempt))
+        self._sequence += 1
+    
+    def submit(self, request_fn, tag=None):
+        """Добавить запрос (функцию без аргументов); можно вызывать и во время run()"""
+        self.budget.add(SUPABASE_RETRY_BUDGET_PER_REQUEST)
+        self._push(0.0, tag, request_fn, 1)
+    
+    def cancel_pending(self):
+        """Снять еще не начатые запросы; уже запланированные повторы остаются в очереди"""
+        self._queue = [item for item in self._queue if item[4] > 1]
+        heapq.heapify(self._queue)
+    
+    def run(self):
+        """
+        Выполнение запросов очереди
+        
+        Yields:
+            Tuple (tag, результат, ошибка, число попыток); ошибка None при успехе,
+            иначе результат None и повторов больше не будет
+        """
+        with ThreadPoolExecutor(max_workers=self.max_in_flight) as executor:
+            pending = {}
+            while pending or self._queue:
+                now = time.monotonic()
+                while self._queue and self._queue[0][0] <= now and len(pending) < self.max_in_flight:
+                    item = heapq.heappop(self._queue)
+                    pending[executor.submit(item[3])] = item
+                if not pending:
+                    time.sleep(max(0.0, self._queue[0][0] - now))
+                    continue
+                timeout = max(0.0, self._queue[0][0] - now) if self._queue and len(pending) < self.max_in_flight else None
+                done, _ = wait(pending, timeout=timeout, return_when=FIRST_COMPLETED)
+                for future in done:
+                    _, _, tag, request_fn, attempt = pending.pop(future)
+                    try:
+                        result = future.result()
+                    except Exception as e:
+                        if (attempt < SUPABASE_RETRY_MAX_ATTEMPTS and is_retryable_supabase_error(e, self.idempotent)
+                                and self.budget.try_acquire()):
+                            delay = supabase_retry_delay(attempt)
+                            self._push(time.monotonic() + delay, tag, request_fn, attempt + 1)
+                            if self.on_retry:
+                                self.on_retry(tag, attempt, e, delay)
+                            continue
+                        yield tag, None, e, attempt
+                        continue
+                    yield tag, result, None, attempt
+
+def run_requests_with_retry(request_fns: List, max_in_flight: int, idempotent: bool = True) -> list:
+    """
+    Выполнение независимых запросов к Supabase с повторами (ScheduledRetryPool)
+    
+    Args:
+        request_fns: Функции без аргументов, выполняющие запросы
+        max_in_flight: Максимальное число одновременных запросов
+        idempotent: Запросы можно безопасно повторить
+        
+    Returns:
+        Результаты в порядке request_fns (первая неповторяемая ошибка пробрасывается)
+    """
+    pool = ScheduledRetryPool(max_in_flight, idempotent)
+    for idx, request_fn in enumerate(request_fns):
+        pool.submit(request_fn, idx)
+    results = [None] * len(request_fns)
+    runner = pool.run()
+    try:
+        for idx, result, error, _ in runner:
+            if error is not None:
+                raise error
+            results[idx] = result
+    finally:
+        runner.close()
+    return results
+
+def call_with_retry(request_fn, idempotent: bool = True, on_retry=None):
+    """
+    Выполнение одного запроса к Supabase с повторами (экспоненциальная задержка + джиттер)
+    
+    Запрос выполняется в ScheduledRetryPool: вызывающий поток только ждет результата
+    и выводит сообщения о повторах.
+    
+    Args:
+        request_fn: Функция без аргументов, выполняющая запрос
+        idempotent: Запрос можно безопасно повторить
+        on_retry: Функция (номер попытки, ошибка, задержка), вызываемая перед повтором
+        
+    Returns:
+        Результат request_fn
+    """
+    pool = ScheduledRetryPool(1, idempotent, on_retry=(lambda tag, attempt, error, delay: on_retry(attempt, error, delay)) if on_retry else None)
+    pool.submit(request_fn)
+    runner = pool.run()
+    try:
+        for _, result, error, _ in runner:
+            if error is not None:
+                raise error
+            return result
+    finally:
+        runner.close()
+
+# Параметры чтения таблиц Supabase
+SUPABASE_PAGE_SIZE = 1000
+SUPABASE_READ_MAX_WORKERS = 4
+
+def quote_columns(columns: List[str]) -> str:
+    """Список колонок для select/order PostgREST (имена с пробелами берутся в кавычки)"""
+    return ','.join(f'"{column}"' for column in columns)
+
+def _apply_filters(query, filters):
+    """Применение фильтров [(оператор, колонка, значение)] к запросу PostgREST"""
+    for operator, column, value in filters or []:
+        query = getattr(query, operator)(column, value)
+    return query
+
+def _read_keyset_page(supabase, table_name: str, select_columns: str, filters, key_column: str,
+                      lower_key, upper_key, page_size: int) -> pd.DataFrame:
+    """
+    Чтение диапазона [lower_key, upper_key) по ключу (выполняется в рабочем потоке)
+    
+    Если строк в диапазоне больше page_size (например, добавились после расчета
+    границ), чтение продолжается от последнего ключа. Повторы при сбоях — на
+    стороне ScheduledRetryPool (диапазон перечитывается целиком).
+    """
+    frames = []
+    lower_op = 'gte'
+    while True:
+        query = _apply_filters(supabase.table(table_name).select(select_columns), filters)
+        if lower_key is not None:
+            query = getattr(query, lower_op)(key_column, lower_key)
+        if upper_key is not None:
+            query = query.lt(key_column, upper_key)
+        query = query.order(quote_columns([key_column])).limit(page_size)
+        rows = query.execute().data or []
+        if rows:
+            frames.append(pd.DataFrame(rows))
+        if len(rows) < page_size:
+            break
+        lower_key, lower_op = rows[-1][key_column], 'gt'
+    if not frames:
+        return pd.DataFrame()
+    return frames[0] if len(frames) == 1 else pd.concat(frames, ignore_index=True)
+
+def _read_offset_page(supabase, table_name: str, select_columns: str, filters, offset: int, page_size: int) -> pd.DataFrame:
+    """Чтение страницы по смещению (запасной режим, когда ключ недоступен)"""
+    query = _apply_filters(supabase.table(table_name).select(select_columns), filters).range(offset, offset + page_size - 1)
+    return pd.DataFrame(query.execute().data or [])
+
+def read_supabase_table(table_name: str, columns: Optional[List[str]] = None, filters=None,
+                        key_column: Optional[str] = None, page_size: int = SUPABASE_PAGE_SIZE,
+                        max_workers: int = SUPABASE_READ_MAX_WORKERS) -> pd.DataFrame:
+    """
+    Параллельное чтение таблицы Supabase страницами
+    
+    С key_column используется keyset-пагинация: границы страниц находятся
+    последовательно — от предыдущей границы запрос пропускает страницу по индексу
+    ключа (gte + order + range), так что поиск всех границ линеен по размеру
+    таблицы. Каждая страница — диапазон ключей, ее чтение начинается сразу, как
+    только известна ее верхняя граница (не больше max_workers запросов одновременно).
+    Если ключевая колонка недоступна, запрашивается число строк и страницы читаются
+    по смещениям. Каждая страница сразу превращается в DataFrame.
+    
+    Args:
+        table_name: Название таблицы
+        columns: Загружаемые колонки (по умолчанию все)
+        filters: Фильтры [(оператор PostgREST, колонка, значение)], например [('eq', 'курс', 'Курс 4')]
+        key_column: Уникальная колонка для keyset-пагинации (первичный ключ)
+        page_size: Размер страницы
+        max_workers: Максимальное число одновременных запросов
+        
+    Returns:
+        DataFrame со строками таблицы (пустой, если строк нет)
+    """
+    supabase = get_supabase_client()
+    select_list = list(columns) if columns else None
+    if key_column and select_list is not None and key_column not in select_list:
+        select_list.append(key_column)
+    select_columns = quote_columns(select_list) if select_list else '*'
+    
+    def select_query(*select_args, **select_kwargs):
+        return _apply_filters(supabase.table(table_name).select(*select_args, **select_kwargs), filters)
+    
+    # Диапазон ключей берется с запасом 10% от страницы: полный ответ означает, что в диапазон
+    # добавились строки после расчета границ, и только тогда нужен дочитывающий запрос
+    rows_per_page = page_size - page_size // 10
+    
+    def next_boundary(lower_key):
+        """Ключ первой строки следующей страницы после lower_key (None — страница последняя)"""
+        query = select_query(quote_columns([key_column]))
+        if lower_key is not None:
+            query = query.gte(key_column, lower_key)
+        response = query.order(quote_columns([key_column])).range(rows_per_page, rows_per_page).execute()
+        return response.data[0][key_column] if response.data else None
+    
+    if key_column:
+        try:
+            first_boundary = call_with_retry(lambda: next_boundary(None))
+        except APIError:
+            # Ключевой колонки нет в таблице — читаем по смещениям
+            key_column, select_list = None, list(columns) if columns else None
+            select_columns = quote_columns(select_list) if select_list else '*'
+    
+    if key_column:
+        pool = ScheduledRetryPool(max_workers)
+        page_frames = {}
+        
+        def schedule_page(page_idx, lower_key, upper_key):
+            # Следующая граница ставится в очередь раньше страницы, чтобы цепочка границ не ждала чтения страниц
+            if upper_key is not None:
+                pool.submit(functools.partial(next_boundary, upper_key), ('boundary', page_idx + 1, upper_key))
+            pool.submit(functools.partial(_read_keyset_page, supabase, table_name, select_columns, filters,
+                                          key_column, lower_key, upper_key, page_size), ('page', page_idx, None))
+        
+        schedule_page(0, None, first_boundary)
+        runner = pool.run()
+        try:
+            for (kind, page_idx, lower_key), result, error, _ in runner:
+                if error is not None:
+                    raise error
+                if kind == 'boundary':
+                    schedule_page(page_idx, lower_key, result)
+                else:
+                    page_frames[page_idx] = result
+        finally:
+            runner.close()
+        frames = [page_frames[page_idx] for page_idx in sorted(page_frames)]
+    else:
+        total = call_with_retry(lambda: select_query(select_columns, count='exact').limit(1).execute()).count or 0
+        if total == 0:
+            return pd.DataFrame(columns=columns)
+        page_count = -(-total // page_size)
+        frames = run_requests_with_retry([
+            functools.partial(_read_offset_page, supabase, table_name, select_columns, filters, page_idx * page_size, page_size)
+            for page_idx in range(page_count)
+        ], min(max_workers, page_count))
+    
+    frames = [frame for frame in frames if not frame.empty]
+    if not frames:
+        return pd.DataFrame(columns=columns)
+    df = pd.concat(frames, ignore_index=True)
+    if columns:
+        df = df.reindex(columns=list(columns))
+    return df
+
+# Снимки таблиц Supabase: в памяти процесса и на диске (Parquet), с ограниченным сроком жизни
+TABLE_SNAPSHOT_TTL_SECONDS = 15 * 60
+TABLE_SNAPSHOT_DIR = os.path.join(tempfile.gettempdir(), 'dataculture_table_snapshots')
+# Ключ df.attrs с версией снимка таблицы
+SNAPSHOT_VERSION_ATTR = 'snapshot_version'
+
+class TableSnapshotCache:
+    """
+    Кэш снимков таблиц Supabase с TTL
+    
+    Снимок хранится в памяти процесса и, если доступен pyarrow, в Parquet-файле на
+    диске — он переживает перезапуск приложения. После записи в таблицу снимки
+    этой таблицы нужно сбросить через invalidate.
+    
+    Каждый снимок получает версию (df.attrs[SNAPSHOT_VERSION_ATTR]) — по ней
+    производные структуры (например, индекс студентов) кэшируются без хеширования данных.
+    """
+
+    def __init__(self, ttl_seconds: int, directory: str):
+        self.ttl_seconds = ttl_seconds
+        self.directory = directory
+        self._entries = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def _path(self, table_name: str, key: tuple) -> str:
+        digest = hashlib.sha1(repr(key).encode('utf-8')).hexdigest()[:16]
+        return os.path.join(self.directory, f"{table_name}_{digest}.parquet")
+
+    @staticmethod
+    def _stamp(path: str, saved_at: float, df: pd.DataFrame) -> Tuple[float, pd.DataFrame]:
+        """Запись кэша с версией снимка в attrs (копии DataFrame ее наследуют)"""
+        df.attrs[SNAPSHOT_VERSION_ATTR] = f"{os.path.basename(path)}@{saved_at!r}"
+        return saved_at, df
+
+    def _read_disk(self, path: str) -> Optional[Tuple[float, pd.DataFrame]]:
+        if not PARQUET_AVAILABLE:
+            return None
+        try:
+            saved_at = os.path.getmtime(path)
+            if time.time() - saved_at > self.ttl_seconds:
+                return None
+            return self._stamp(path, saved_at, pd.read_parquet(path))
+        except (OSError, ValueError):
+            return None
+
+    def _write_disk(self, path: str, df: pd.DataFrame):
+        if not PARQUET_AVAILABLE:
+            return
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            temp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+            df.to_parquet(temp_path, index=False)
+            os.replace(temp_path, path)
+        except (OSError, ValueError, ImportError):
+            # Диск недоступен или типы колонок не пишутся в Parquet — остается снимок в памяти
+            pass
+
+    def get_or_load(self, table_name: str, key: tuple, load_fn) -> pd.DataFrame:
+        """
+        Возвращает копию свежего снимка или загружает таблицу
+        
+        Args:
+            table_name: Таблица, к которой относится снимок (для invalidate)
+            key: Параметры запроса (фильтры, колонки)
+            load_fn: Функция без аргументов, загружающая DataFrame
+            
+        Returns:
+            Копия DataFrame с версией снимка в attrs (вызывающий код может его
+            изменять, но тогда должен убрать версию из attrs)
+        """
+        full_key = (table_name, key)
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(full_key)
+            if entry is not None and now - entry[0] <= self.ttl_seconds:
+                self.hits += 1
+                return entry[1].copy()
+        
+        path = self._path(table_name, key)
+        disk_entry = self._read_disk(path)
+        if disk_entry is not None:
+            with self._lock:
+                self._entries[full_key] = disk_entry
+                self.hits += 1
+            return disk_entry[1].copy()
+        
+        with self._lock:
+            self.misses += 1
+        df = load_fn()
+        # Пустой результат (в т.ч. после ошибки загрузки) не кэшируется
+        if not df.empty:
+            self._write_disk(path, df)
+            with self._lock:
+                self._entries[full_key] = self._stamp(path, now, df)
+        return df.copy()
+
+    def invalidate(self, table_name: str):
+        """Сброс всех снимков таблицы (в памяти и на диске)"""
+        with self._lock:
+            for full_key in [full_key for full_key in self._entries if full_key[0] == table_name]:
+                del self._entries[full_key]
+        try:
+            for file_name in os.listdir(self.directory):
+                if file_name.startswith(f"{table_name}_") and file_name.endswith('.parquet'):
+                    os.remove(os.path.join(self.directory, file_name))
+        except OSError:
+            pass
+
+    def stats(self) -> Dict[str, int]:
+        """Метрики кэша: снимки в памяти, попадания, промахи"""
+        with self._lock:
+            return {'entries': len(self._entries), 'hits': self.hits, 'misses': self.misses}
+
+@st.cache_resource
+def get_table_snapshot_cache() -> TableSnapshotCache:
+    """Общий для всех сессий кэш снимков таблиц Supabase"""
+    return TableSnapshotCache(TABLE_SNAPSHOT_TTL_SECONDS, TABLE_SNAPSHOT_DIR)
+
+# Колонки таблицы students -> названия колонок в приложении
+STUDENT_COLUMN_LABELS = {
+    'корпоративная_почта': 'Адрес электронной почты',
+    'фио': 'ФИО',
+    'филиал_кампус': 'Филиал (кампус)',
+    'факультет': 'Факультет',
+    'образовательная_программа': 'Образовательная программа',
+    'версия_образовательной_программы': 'Версия образовательной программы',
+    'группа': 'Группа',
+    'курс': 'Курс',
+    'уровень_образования': 'Уровень образования'
+}
+
+# Колонки students с небольшим числом повторяющихся значений — хранятся как category
+STUDENT_CATEGORICAL_FIELDS = ['филиал_кампус', 'факультет', 'образовательная_программа', 'группа', 'курс']
+
+def to_categorical_columns(df: pd.DataFrame, columns: List[str]) -> pd.DataFrame:
+    """Перевод указанных (существующих) колонок в dtype category"""
+    present = [col for col in columns if col in df.columns and not isinstance(df[col].dtype, pd.CategoricalDtype)]
+    if not present:
+        return df
+    return df.astype({col: 'category' for col in present})
+
+def build_student_filters(courses=None, campuses=None, faculties=None, levels=None) -> List[tuple]:
+    """
+    Фильтры PostgREST для таблицы students (выполняются на стороне сервера)
+    
+    Args:
+        courses: Курсы (например, ['Курс 4'])
+        campuses: Филиалы (кампусы)
+        faculties: Факультеты
+        levels: Уровни образования
+        
+    Returns:
+        Список фильтров [(оператор, колонка, значение)] для read_supabase_table
+    """
+    filters = []
+    for column, values in (('курс', courses), ('филиал_кампус', campuses),
+                           ('факультет', faculties), ('уровень_образования', levels)):
+        if not values:
+            continue
+        values = [values] if isinstance(values, str) else list(values)
+        if len(values) == 1:
+            filters.append(('eq', column, values[0]))
+        else:
+            filters.append(('in_', column, tuple(values)))
+    return filters
+
+def load_students_from_supabase(courses=('Курс 4',), campuses=None, faculties=None, levels=None,
+                                columns: Optional[List[str]] = None, as_categories: bool = False) -> pd.DataFrame:
     """
     Загрузка списка студентов из Supabase (все записи с пагинацией)
     Автоматически переименовывает колонки в требуемый формат
-    Фильтрует студентов по курсу = "Курс 4"
+    По умолчанию фильтрует студентов по курсу = "Курс 4"
+    Фильтры и список колонок передаются в PostgREST — загружается только нужный срез
+    Результат берется из снимка таблицы, если он моложе TABLE_SNAPSHOT_TTL_SECONDS
+    
+    Args:
+        courses: Курсы (None — все)
+        campuses: Филиалы (кампусы) (None — все)
+        faculties: Факультеты (None — все)
+        levels: Уровни образования (None — все)
+        columns: Колонки таблицы students (None — все)
+        as_categories: Вернуть филиал, факультет, программу, группу и курс как category
+            (снимок хранится в том же виде — памяти нужно в разы меньше)
     
     Returns:
-        DataFrame со студентами с переименованными колонками и фильтром по курсу
+        DataFrame со студентами с переименованными колонками
     """
     try:
-        supabase = get_supabase_client()
+        filters = build_student_filters(courses, campuses, faculties, levels)
+        columns = list(columns) if columns else None
         
-        # Загружаем все записи с пагинацией и фильтром по курсу
-        all_data = []
-        page_size = 1000
-        offset = 0
+        def load_students():
+            df = read_supabase_table('students', columns=columns, filters=filters, key_column='корпоративная_почта')
+            return to_categorical_columns(df, STUDENT_CATEGORICAL_FIELDS) if as_categories else df
         
-        while True:
-            # Добавляем фильтр по курсу = "Курс 4"
-            response = supabase.table('students').select('*').eq('курс', 'Курс 4').range(offset, offset + page_size - 1).execute()
-            
-            if response.data:
-                all_data.extend(response.data)
-                
-                # Если получили меньше записей, чем page_size, значит это последняя страница
-                if len(response.data) < page_size:
-                    break
-                    
-                offset += page_size
-            else:
-                break
+        df = get_table_snapshot_cache().get_or_load(
+            'students', (tuple(filters), tuple(columns or ()), as_categories), load_students
+        )
         
-        if all_data:
-            df = pd.DataFrame(all_data)
-            
-            # Переименование колонок из формата Supabase в требуемый формат
-            column_mapping = {
-                'корпоративная_почта': 'Адрес электронной почты',
-                'фио': 'ФИО',
-                'филиал_кампус': 'Филиал (кампус)',
-                'факультет': 'Факультет',
-                'образовательная_программа': 'Образовательная программа',
-                'версия_образовательной_программы': 'Версия образовательной программы',
-                'группа': 'Группа',
-                'курс': 'Курс'
-            }
-            
+        if not df.empty:
             # Переименовываем только те колонки, которые существуют
-            existing_columns = {k: v for k, v in column_mapping.items() if k in df.columns}
+            existing_columns = {k: v for k, v in STUDENT_COLUMN_LABELS.items() if k in df.columns}
             df = df.rename(columns=existing_columns)
             
             return df
         else:
-            st.warning("⚠️ Таблица students пуста или нет студентов на Курсе 4 в Supabase")
+            st.warning("⚠️ Таблица students пуста или нет студентов, подходящих под фильтр, в Supabase")
             return pd.DataFrame()
     except Exception as e:
         st.error(f"❌ Ошибка при загрузке студентов из Supabase: {str(e)}")
@@ -684,50 +1670,95 @@ def create_peresdachi_table_if_not_exists():
     """
     pass  # Таблица создается вручную в Supabase
 
-def load_existing_peresdachi() -> pd.DataFrame:
+# Ключ записи пересдачи: новые записи определяются по паре (email, дисциплина)
+PERESDACHI_KEY_COLUMNS = ['Адрес электронной почты', 'Наименование дисциплины']
+# Число email в одном фильтре in (ограничено длиной URL запроса)
+PERESDACHI_KEY_CHUNK_SIZE = 100
+
+def load_existing_peresdachi(columns: Optional[List[str]] = None) -> pd.DataFrame:
     """
     Загрузка существующих записей из таблицы peresdachi (все записи с пагинацией)
     
+    Args:
+        columns: Загружаемые колонки (по умолчанию все) — запрашиваются только они,
+            что уменьшает объем ответа
+    
     Returns:
         DataFrame с существующими пересдачами
     """
     try:
-        supabase = get_supabase_client()
-        
-        # Загружаем все записи с пагинацией
-        all_data = []
-        page_size = 1000
-        offset = 0
-        
-        while True:
-            response = supabase.table('peresdachi').select('*').range(offset, offset + page_size - 1).execute()
-            
-            if response.data:
-                all_data.extend(response.data)
-                
-                # Если получили меньше записей, чем page_size, значит это последняя страница
-                if len(response.data) < page_size:
-                    break
-                    
-                offset += page_size
-            else:
-                break
-        
-        if all_data:
-            return pd.DataFrame(all_data)
-        else:
-            return pd.DataFrame()
+        # Keyset-пагинация по id (если колонки нет — чтение по смещениям)
+        return read_supabase_table('peresdachi', columns=columns, key_column='id')
     except Exception as e:
         # Если таблица не существует, возвращаем пустой DataFrame
         st.warning(f"⚠️ Таблица peresdachi не найдена или пуста: {str(e)}")
         return pd.DataFrame()
 
-def save_to_supabase(df: pd.DataFrame) -> Tuple[int, int]:
+def fetch_existing_peresdachi_keys(df: pd.DataFrame, page_size: int = 1000) -> pd.DataFrame:
+    """
+    Ключи записей peresdachi только для email, встречающихся в df
+    
+    Таблица не читается целиком: email запрашиваются чанками через фильтр in
+    (несколько чанков одновременно), поэтому стоимость зависит от размера загрузки, а не таблицы.
+    
+    Args:
+        df: DataFrame с обрабатываемыми записями
+        page_size: Размер страницы ответа
+        
+    Returns:
+        DataFrame с колонками PERESDACHI_KEY_COLUMNS
+    """
+    email_col = PERESDACHI_KEY_COLUMNS[0]
+    if email_col not in df.columns:
+        return pd.DataFrame(columns=PERESDACHI_KEY_COLUMNS)
+    
+    supabase = get_supabase_client()
+    emails = df[email_col].dropna().astype(str).unique().tolist()
+    
+    def read_chunk_keys(chunk):
+        chunk_rows = []
+        offset = 0
+        while True:
+            response = (supabase.table('peresdachi').select(quote_columns(PERESDACHI_KEY_COLUMNS))
+                        .in_(email_col, chunk).order(quote_columns(PERESDACHI_KEY_COLUMNS))
+                        .range(offset, offset + page_size - 1).execute())
+            chunk_rows.extend(response.data or [])
+            if not response.data or len(response.data) < page_size:
+                return chunk_rows
+            offset += page_size
+    
+    chunk_requests = [
+        functools.partial(read_chunk_keys, emails[start:start + PERESDACHI_KEY_CHUNK_SIZE])
+        for start in range(0, len(emails), PERESDACHI_KEY_CHUNK_SIZE)
+    ]
+    key_rows = [row for chunk_rows in run_requests_with_retry(chunk_requests, SUPABASE_READ_MAX_WORKERS) for row in chunk_rows]
+    return pd.DataFrame(key_rows, columns=PERESDACHI_KEY_COLUMNS)
+
+def filter_new_peresdachi(df: pd.DataFrame, existing_keys: pd.DataFrame) -> pd.DataFrame:
+    """
+    Записи df, ключа которых (email, дисциплина) еще нет в базе
+    
+    Args:
+        df: DataFrame с обрабатываемыми записями
+        existing_keys: Ключи существующих записей (fetch_existing_peresdachi_keys)
+        
+    Returns:
+        DataFrame только с новыми записями
+    """
+    if existing_keys.empty or not all(col in df.columns for col in PERESDACHI_KEY_COLUMNS):
+        return df
+    existing_index = pd.MultiIndex.from_frame(existing_keys[PERESDACHI_KEY_COLUMNS])
+    is_existing = pd.MultiIndex.from_frame(df[PERESDACHI_KEY_COLUMNS]).isin(existing_index)
+    return df[~is_existing]
+
+def save_to_supabase(df: pd.DataFrame, existing_keys: pd.DataFrame = None) -> Tuple[int, int]:
     """
     Сохранение данных в таблицу peresdachi в Supabase
     
     Args:
         df: DataFrame с новыми данными
+        existing_keys: Снимок ключей существующих записей, взятый в этом запуске
+            (по умолчанию запрашивается заново)
         
     Returns:
         Tuple (количество новых записей, общее количество записей)
@@ -735,33 +1766,11 @@ def save_to_supabase(df: pd.DataFrame) -> Tuple[int, int]:
     try:
         supabase = get_supabase_client()
         
-        # Загружаем существующие записи
-        existing_df = load_existing_peresdachi()
-        
-        if existing_df.empty:
-            # Если таблица пуста, все записи новые
-            new_records = df.to_dict('records')
-            new_count = len(new_records)
-        else:
-            # Определяем новые записи (по комбинации email + дисциплина + оценка)
-            merge_cols = ['Адрес электронной почты', 'Наименование дисциплины']
-            
-            # Проверяем наличие необходимых колонок
-            if all(col in existing_df.columns for col in merge_cols) and all(col in df.columns for col in merge_cols):
-                # Находим новые записи
-                merged = df.merge(
-                    existing_df[merge_cols],
-                    on=merge_cols,
-                    how='left',
-                    indicator=True
-                )
-                new_df = merged[merged['_merge'] == 'left_only'].drop('_merge', axis=1)
-                new_records = new_df.to_dict('records')
-                new_count = len(new_records)
-            else:
-                # Если колонки не совпадают, сохраняем все как новые
-                new_records = df.to_dict('records')
-                new_count = len(new_records)
+        # Ключи существующих записей — только для email из загрузки
+        if existing_keys is None:
+            existing_keys = fetch_existing_peresdachi_keys(df)
+        new_records = filter_new_peresdachi(df, existing_keys).to_dict('records')
+        new_count = len(new_records)
         
         # Вставляем новые записи
         if new_records:
@@ -771,7 +1780,14 @@ def save_to_supabase(df: pd.DataFrame) -> Tuple[int, int]:
                 cleaned_record = {k: (v if pd.notna(v) else None) for k, v in record.items()}
                 cleaned_records.append(cleaned_record)
             
-            response = supabase.table('peresdachi').insert(cleaned_records).execute()
+            # insert не идемпотентен: повторяются только ошибки, при которых запись точно не применилась
+            call_with_retry(
+                lambda: supabase.table('peresdachi').insert(cleaned_records).execute(),
+                idempotent=False,
+                on_retry=lambda attempt, error, delay: st.warning(
+                    f"⚠️ Сбой сохранения в Supabase ({error}), повтор через {delay:.1f} с (попытка {attempt + 1}/{SUPABASE_RETRY_MAX_ATTEMPTS})"
+                )
+            )
             
         return new_count, len(df)
         
@@ -779,40 +1795,144 @@ def save_to_supabase(df: pd.DataFrame) -> Tuple[int, int]:
         st.error(f"❌ Ошибка при сохранении в Supabase: {str(e)}")
         raise e
 
-def get_new_records(all_df: pd.DataFrame) -> pd.DataFrame:
+def get_new_records(all_df: pd.DataFrame, existing_keys: pd.DataFrame = None) -> pd.DataFrame:
     """
     Получить только новые записи, которых еще нет в базе
     
     Args:
         all_df: DataFrame со всеми обработанными записями
+        existing_keys: Снимок ключей существующих записей, взятый в этом запуске
+            (по умолчанию запрашивается заново)
         
     Returns:
         DataFrame только с новыми записями
     """
     try:
-        existing_df = load_existing_peresdachi()
-        
-        if existing_df.empty:
-            return all_df
-        
-        merge_cols = ['Адрес электронной почты', 'Наименование дисциплины']
-        
-        if all(col in existing_df.columns for col in merge_cols) and all(col in all_df.columns for col in merge_cols):
-            merged = all_df.merge(
-                existing_df[merge_cols],
-                on=merge_cols,
-                how='left',
-                indicator=True
-            )
-            new_df = merged[merged['_merge'] == 'left_only'].drop('_merge', axis=1)
-            return new_df
-        else:
-            return all_df
+        if existing_keys is None:
+            existing_keys = fetch_existing_peresdachi_keys(all_df)
+        return filter_new_peresdachi(all_df, existing_keys)
             
     except Exception as e:
         st.warning(f"⚠️ Ошибка при определении новых записей: {str(e)}")
         return all_df
 
+# Колонки students, нужные для обработки пересдач (запрашиваются только они)
+EXTERNAL_ASSESSMENT_STUDENT_FIELDS = [
+    'фио', 'корпоративная_почта', 'филиал_кампус', 'факультет',
+    'образовательная_программа', 'группа', 'курс'
+]
+
+EXTERNAL_ASSESSMENT_SOURCE_COLUMNS = (
+    'Адрес электронной почты',
+    'Тест:Входное тестирование (Значение)',
+    'Тест:Промежуточное тестирование (Значение)',
+    'Тест:Итоговое тестирование (Значение)'
+)
+
+def _is_external_assessment_column(col) -> bool:
+    """Нужна ли колонка файла с оценками внешней системы (остальные не читаются)"""
+    return col in EXTERNAL_ASSESSMENT_SOURCE_COLUMNS
+
+# Индексы email -> строка студента, построенные по снимкам списка студентов
+STUDENT_INDEX_CACHE_SIZE = 8
+
+def normalize_emails(emails: pd.Series) -> pd.Series:
+    """Приведение email к ключу соединения (строка без пробелов по краям, нижний регистр)"""
+    return emails.astype(str).str.strip().str.lower()
+
+class StudentEmailIndex:
+    """
+    Индекс списка студентов по нормализованному email
+    
+    Ключи хранятся как категории: позиция email в категориях находится хешированием,
+    а по ней — номер строки студента. Соединение с таблицей оценок сводится к take
+    по номерам строк без повторной нормализации списка студентов.
+    """
+
+    def __init__(self, students_df: pd.DataFrame, columns: List[str], email_column: str = 'Адрес электронной почты'):
+        self.email_column = email_column
+        self.columns = [col for col in columns if col != email_column]
+        keys = normalize_emails(students_df[email_column])
+        # При повторе email используется первая строка (в таблице students email — первичный ключ)
+        first_rows = ~keys.duplicated().to_numpy()
+        self.keys = pd.CategoricalDtype(keys[first_rows].to_numpy())
+        self.attributes = students_df.loc[first_rows, self.columns].reset_index(drop=True)
+
+    def __len__(self) -> int:
+        return len(self.attributes)
+
+    def positions(self, normalized_emails: pd.Series) -> np.ndarray:
+        """Номера строк студентов для нормализованных email (-1 — студент не найден)"""
+        return pd.Categorical(normalized_emails, dtype=self.keys).codes.astype(np.intp)
+
+    def unmatched(self, normalized_emails: pd.Series, positions: np.ndarray = None) -> List[str]:
+        """Email, которых нет в списке студентов (уникальные, в порядке появления)"""
+        if positions is None:
+            positions = self.positions(normalized_emails)
+        missing = normalized_emails[positions < 0]
+        return missing.drop_duplicates().tolist()
+
+    def join(self, df: pd.DataFrame, positions: np.ndarray) -> pd.DataFrame:
+        """
+        Присоединение данных студентов к df по заранее найденным номерам строк
+        
+        Аналог left merge: для ненайденных студентов колонки остаются пустыми.
+        """
+        result = df.copy()
+        for col in self.columns:
+            result[col] = self.attributes[col].array.take(positions, allow_fill=True)
+        return result
+
+@st.cache_resource
+def get_student_index_cache() -> OrderedDict:
+    """Общий для всех сессий кэш индексов студентов (ключ — отпечаток списка)"""
+    return OrderedDict()
+
+# Кэш индексов общий для сессий: чтение, перестановка и вытеснение — под блокировкой
+_student_index_cache_lock = threading.Lock()
+
+def get_student_email_index(students_df: pd.DataFrame, columns: List[str],
+                            email_column: str = 'Адрес электронной почты') -> StudentEmailIndex:
+    """
+    Индекс студентов по email, построенный один раз для одного и того же списка
+    
+    Для снимка из TableSnapshotCache ключ кэша — версия снимка; для остальных
+    DataFrame — хеш используемых колонок.
+    
+    Args:
+        students_df: DataFrame со списком студентов
+        columns: Колонки студентов, которые нужны после соединения
+        email_column: Колонка с email
+        
+    Returns:
+        StudentEmailIndex
+    """
+    used_columns = [email_column] + [col for col in columns if col != email_column]
+    snapshot_version = students_df.attrs.get(SNAPSHOT_VERSION_ATTR)
+    if snapshot_version is not None:
+        fingerprint = (snapshot_version, len(students_df))
+    else:
+        fingerprint = hashlib.sha1(
+            pd.util.hash_pandas_object(students_df[used_columns], index=False).to_numpy().tobytes()
+        ).hexdigest()
+    # dtype входит в ключ: хеш значений одинаков для object и category
+    cache_key = (fingerprint, tuple(used_columns), tuple(str(students_df[col].dtype) for col in used_columns))
+    cache = get_student_index_cache()
+    with _student_index_cache_lock:
+        index = cache.get(cache_key)
+        if index is not None:
+            cache.move_to_end(cache_key)
+            return index
+    
+    # Индекс строится вне блокировки — другие сессии не ждут построения
+    index = StudentEmailIndex(students_df, used_columns, email_column)
+    with _student_index_cache_lock:
+        index = cache.setdefault(cache_key, index)
+        cache.move_to_end(cache_key)
+        while len(cache) > STUDENT_INDEX_CACHE_SIZE:
+            cache.popitem(last=False)
+    return index
+
 def process_external_assessment(grades_df: pd.DataFrame, students_df: pd.DataFrame) -> pd.DataFrame:
     """
     Обработка пересдач внешней оценки
@@ -824,21 +1944,13 @@ def process_external_assessment(grades_df: pd.DataFrame, students_df: pd.DataFra
     Returns:
         Обработанный DataFrame с итоговыми данными
     """
-    # Шаг 1: Очистка данных - удаление "-" и лишних пробелов
-    for col in grades_df.columns:
-        if grades_df[col].dtype == 'object':
-            grades_df[col] = grades_df[col].astype(str).str.replace('-', '', regex=False).str.strip()
-    
-    # Шаг 2: Переименование колонок
+    # Шаг 1: Переименование колонок
     column_mapping = {
         'Тест:Входное тестирование (Значение)': 'Внешнее измерение цифровых компетенций. Входной контроль',
         'Тест:Промежуточное тестирование (Значение)': 'Внешнее измерение цифровых компетенций. Промежуточный контроль',
         'Тест:Итоговое тестирование (Значение)': 'Внешнее измерение цифровых компетенций. Итоговый контроль'
     }
     
-    grades_df = grades_df.rename(columns=column_mapping)
-    
-    # Шаг 3: Melt - преобразование колонок в строки
     value_columns = [
         'Внешнее измерение цифровых компетенций. Входной контроль',
         'Внешнее измерение цифровых компетенций. Промежуточный контроль',
@@ -851,6 +1963,20 @@ def process_external_assessment(grades_df: pd.DataFrame, students_df: pd.DataFra
         st.error("Колонка 'Адрес электронной почты' не найдена в файле оценок")
         return pd.DataFrame()
     
+    # Берем только колонки, которые переживут melt — исходный DataFrame не изменяется
+    used_columns = [
+        col for col in grades_df.columns
+        if col in id_cols or column_mapping.get(col, col) in value_columns
+    ]
+    grades_df = grades_df[used_columns].rename(columns=column_mapping)
+    
+    # Шаг 2: Очистка данных - удаление "-" и лишних пробелов в оценках, нормализация email
+    for col in value_columns:
+        if col in grades_df.columns and grades_df[col].dtype == 'object':
+            grades_df[col] = grades_df[col].astype(str).str.replace('-', '', regex=False).str.strip()
+    grades_df['Адрес электронной почты'] = normalize_emails(grades_df['Адрес электронной почты'])
+    
+    # Шаг 3: Melt - преобразование колонок в строки
     melted_df = pd.melt(
         grades_df,
         id_vars=id_cols,
@@ -871,17 +1997,17 @@ def process_external_assessment(grades_df: pd.DataFrame, students_df: pd.DataFra
     else:
         available_cols = students_cols
     
-    students_subset = students_df[available_cols].copy()
+    # Индекс студентов по email строится один раз для одного и того же списка
+    student_index = get_student_email_index(students_df, available_cols)
     
-    # Очистка email в обоих файлах для корректного соединения
-    melted_df['Адрес электронной почты'] = melted_df['Адрес электронной почты'].astype(str).str.strip().str.lower()
-    students_subset['Адрес электронной почты'] = students_subset['Адрес электронной почты'].astype(str).str.strip().str.lower()
+    # Соединение через индекс по уже нормализованным email
+    positions = student_index.positions(melted_df['Адрес электронной почты'])
+    result_df = student_index.join(melted_df, positions)
     
-    result_df = melted_df.merge(
-        students_subset,
-        on='Адрес электронной почты',
-        how='left'
-    )
+    unmatched_emails = student_index.unmatched(melted_df['Адрес электронной почты'], positions)
+    if unmatched_emails:
+        examples = ', '.join(unmatched_emails[:5])
+        st.warning(f"⚠️ Не найдено в списке студентов: {len(unmatched_emails)} email (например: {examples})")
     
     # Шаг 5: Добавление пустых колонок
     result_df['ID дисциплины'] = ''
@@ -902,58 +2028,56 @@ def process_external_assessment(grades_df: pd.DataFrame, students_df: pd.DataFra
     final_columns = [col for col in output_columns if col in result_df.columns]
     result_df = result_df[final_columns]
     
-    # Удаление строк с пустыми оценками или некорректными значениями
-    result_df = result_df[result_df['Оценка'].notna()]
-    result_df = result_df[result_df['Оценка'].astype(str).str.strip() != '']
-    result_df = result_df[result_df['Оценка'].astype(str).str.strip() != 'nan']
+    # Удаление строк с пустыми оценками или некорректными значениями (одной маской)
+    grades = result_df['Оценка']
+    grade_text = grades.astype(str).str.strip()
+    result_df = result_df[grades.notna() & (grade_text != '') & (grade_text != 'nan')]
     
     return result_df
 
 def process_student_data(df: pd.DataFrame, grade_mapping: Dict[str, str]) -> Tuple[pd.DataFrame, list]:
     """Обработка данных студентов для сертификатов"""
-    results = []
     processing_log = []
     
     processing_log.append(f"📊 Обрабатываем {len(df)} студентов")
     
-    for index, row in df.iterrows():
-        student_results = []
-        processed_keys = set()
-        
-        for discipline_num in range(1, 4):
-            discipline_col = f"Дисциплина {discipline_num}"
-            grade_5_col = f"Оценка 5 баллов Дисциплина {discipline_num}"
-            
-            if discipline_col not in df.columns or grade_5_col not in df.columns:
-                continue
-                
-            discipline_value = str(row[discipline_col]).strip()
-            grade_value = str(row[grade_5_col]).strip()
-            
-            if pd.isna(discipline_value) or pd.isna(grade_value) or discipline_value == 'nan' or grade_value == 'nan':
-                continue
-            
-            lookup_key = f"{discipline_value}—{grade_value}"
-            
-            if lookup_key in processed_keys:
-                continue
-            
-            if lookup_key in grade_mapping:
-                skill_description = grade_mapping[lookup_key]
-                
-                short_name_col = f"Название Дисциплины {discipline_num}"
-                if short_name_col in df.columns:
-                    display_name = str(row[short_name_col]).strip()
-                    formatted_discipline = display_name.capitalize() if display_name != 'nan' and display_name else discipline_value
-                else:
-                    formatted_discipline = discipline_value
-                
-                formatted_result = f"📚 {formatted_discipline}:\n{skill_description}"
-                student_results.append(formatted_result)
-                processed_keys.add(lookup_key)
-        
-        final_result = "\n\n".join(student_results) if student_results else "Навыки не найдены."
-        results.append(final_result)
+    # Слоты дисциплин в длинном формате: строка студента, номер слота, дисциплина, оценка, короткое название
+    slot_frames = []
+    for discipline_num in range(1, 4):
+        discipline_col = f"Дисциплина {discipline_num}"
+        grade_5_col = f"Оценка 5 баллов Дисциплина {discipline_num}"
+        
+        if discipline_col not in df.columns or grade_5_col not in df.columns:
+            continue
+        
+        short_name_col = f"Название Дисциплины {discipline_num}"
+        slot_frames.append(pd.DataFrame({
+            'row': np.arange(len(df)),
+            'slot': discipline_num,
+            'discipline': df[discipline_col].astype(str).str.strip().to_numpy(),
+            'grade': df[grade_5_col].astype(str).str.strip().to_numpy(),
+            'display': df[short_name_col].astype(str).str.strip().to_numpy() if short_name_col in df.columns else None,
+        }))
+    
+    results = np.full(len(df), "Навыки не найдены.", dtype=object)
+    if slot_frames:
+        slots = pd.concat(slot_frames, ignore_index=True)
+        slots = slots[(slots['discipline'] != 'nan') & (slots['grade'] != 'nan')]
+        slots['key'] = slots['discipline'] + '—' + slots['grade']
+        
+        # Соединение со справочником навыков по ключу "дисциплина—оценка"
+        skills = pd.Series(grade_mapping, dtype=object)
+        slots = slots[slots['key'].isin(skills.index)]
+        slots = slots.sort_values(['row', 'slot'], kind='stable').drop_duplicates(['row', 'key'])
+        
+        display = slots['display']
+        has_display = display.notna() & (display != 'nan') & (display != '')
+        formatted_discipline = slots['discipline'].copy()
+        formatted_discipline[has_display] = display[has_display].str.capitalize()
+        slots['text'] = "📚 " + formatted_discipline + ":\n" + slots['key'].map(skills).astype(str)
+        
+        student_texts = slots.groupby('row', sort=True)['text'].agg("\n\n".join)
+        results[student_texts.index.to_numpy()] = student_texts.to_numpy()
     
     processing_log.append(f"✅ Успешно обработано")
     
@@ -970,75 +2094,339 @@ def process_student_data(df: pd.DataFrame, grade_mapping: Dict[str, str]) -> Tup
 # ФУНКЦИИ ДЛЯ МОДУЛЯ 5: АНАЛИТИКА КУРСОВ
 # =============================================================================
 
-from io import StringIO
-import time
+# Параметры конвейера загрузки в Supabase
+UPSERT_MAX_IN_FLIGHT = 4
+UPSERT_MAX_BATCH_BYTES = 512 * 1024
+UPSERT_MAX_BATCH_ROWS = 2000
+
+# Журнал загруженных батчей для возобновления прерванной загрузки
+UPLOAD_JOURNAL_PATH = os.path.join(tempfile.gettempdir(), 'dataculture_upload_journal.sqlite3')
+UPLOAD_JOURNAL_RETENTION_HOURS = 24
+
+class UploadJournal:
+    """
+    Локальный журнал (SQLite) батчей, уже записанных в Supabase
+    
+    Запись журнала — пара (хеш области, таблицы и параметров upsert, хеш содержимого
+    батча). Область — сессия пользователя: возобновляется только загрузка, прерванная
+    в этой же сессии, а батч с тем же содержимым из другой сессии отправляется заново
+    (строки в базе могли измениться). Внутри области батч пропускается, даже когда
+    набор батчей при повторном запуске изменился (например, дельта стала меньше).
+    После полного успеха записи о батчах загрузки удаляются.
+    
+    Используется как контекстный менеджер: соединение закрывается и при исключении.
+    """
+    
+    def __init__(self, path: str = UPLOAD_JOURNAL_PATH):
+        self._conn = sqlite3.connect(path, timeout=10)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS committed_batches ("
+            "upload_key TEXT NOT NULL, batch_key TEXT NOT NULL, rows INTEGER NOT NULL, "
+            "committed_at TEXT NOT NULL, PRIMARY KEY (upload_key, batch_key))"
+        )
+        self._conn.execute(
+            "DELETE FROM committed_batches WHERE committed_at < datetime('now', ?)",
+            (f'-{UPLOAD_JOURNAL_RETENTION_HOURS} hours',)
+        )
+        self._conn.commit()
+    
+    @staticmethod
+    def batch_key(batch: List[dict]) -> str:
+        payload = json.dumps(batch, ensure_ascii=False, default=str, sort_keys=True)
+        return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+    
+    @staticmethod
+    def upload_key(scope: str, table_name: str, upsert_options: dict) -> str:
+        digest = hashlib.sha256(scope.encode('utf-8'))
+        digest.update(b'\x1f')
+        digest.update(table_name.encode('utf-8'))
+        digest.update(json.dumps(upsert_options, ensure_ascii=False, sort_keys=True).encode('utf-8'))
+        return digest.hexdigest()
+    
+    def __enter__(self) -> 'UploadJournal':
+        return self
+    
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+    
+    def committed(self, upload_key: str, batch_keys: List[str]) -> set:
+        """Ключи из batch_keys, уже записанные в Supabase для этой таблицы и параметров"""
+        committed = set()
+        unique_keys = list(dict.fromkeys(batch_keys))
+        # Не больше 500 параметров на запрос (лимит SQLite — 999)
+        for start in range(0, len(unique_keys), 500):
+            chunk = unique_keys[start:start + 500]
+            rows = self._conn.execute(
+                f"SELECT batch_key FROM committed_batches WHERE upload_key = ? AND batch_key IN ({','.join('?' * len(chunk))})",
+                (upload_key, *chunk)
+            ).fetchall()
+            committed.update(row[0] for row in rows)
+        return committed
+    
+    def mark_committed(self, upload_key: str, batch_key: str, rows: int):
+        self._conn.execute(
+            "INSERT OR REPLACE INTO committed_batches VALUES (?, ?, ?, datetime('now'))",
+            (upload_key, batch_key, rows)
+        )
+        self._conn.commit()
+    
+    def finish(self, upload_key: str, batch_keys: List[str]):
+        """Загрузка завершена полностью — записи о ее батчах больше не нужны"""
+        self._conn.executemany(
+            "DELETE FROM committed_batches WHERE upload_key = ? AND batch_key = ?",
+            [(upload_key, key) for key in batch_keys]
+        )
+        self._conn.commit()
+    
+    def close(self):
+        self._conn.close()
+
+def open_upload_journal(report=_st_report) -> Optional[UploadJournal]:
+    """Открыть журнал загрузок (None, если файл журнала недоступен — загрузка идет без него)"""
+    try:
+        return UploadJournal()
+    except sqlite3.Error as e:
+        report('warning', f"⚠️ Журнал загрузки недоступен, возобновление отключено: {e}")
+        return None
+
+def split_records_by_size(records: List[dict], max_batch_bytes: int = UPSERT_MAX_BATCH_BYTES,
+                          max_batch_rows: int = UPSERT_MAX_BATCH_ROWS):
+    """
+    Разбиение записей на батчи по размеру JSON-тела запроса
+    
+    Args:
+        records: Список записей для отправки
+        max_batch_bytes: Максимальный размер тела запроса в байтах
+        max_batch_rows: Максимальное число записей в батче
+        
+    Yields:
+        Списки записей (батчи)
+    """
+    batch = []
+    batch_bytes = 2
+    for record in records:
+        record_bytes = len(json.dumps(record, ensure_ascii=False, default=str).encode('utf-8')) + 1
+        if batch and (batch_bytes + record_bytes > max_batch_bytes or len(batch) >= max_batch_rows):
+            yield batch
+            batch = []
+            batch_bytes = 2
+        batch.append(record)
+        batch_bytes += record_bytes
+    if batch:
+        yield batch
+
+def _send_upsert_batch(supabase, table_name: str, batch: List[dict], upsert_options: dict):
+    """Отправка одного батча (выполняется в рабочем потоке, без вызовов Streamlit)"""
+    supabase.table(table_name).upsert(batch, **upsert_options).execute()
+
+def upsert_records_concurrently(supabase, table_name: str, records: List[dict], upsert_options: dict,
+                                report=_st_report, label: str = "Батч",
+                                max_in_flight: int = UPSERT_MAX_IN_FLIGHT,
+                                max_batch_bytes: int = UPSERT_MAX_BATCH_BYTES,
+                                journal_scope: Optional[str] = None) -> Tuple[bool, int]:
+    """
+    Конвейерная загрузка записей в таблицу Supabase несколькими батчами одновременно
+    
+    Батчи формируются по размеру тела запроса, одновременно в полете не больше
+    max_in_flight запросов. Батч с повторяемой ошибкой откладывается с экспоненциальной
+    задержкой и джиттером, не занимая рабочий поток, — остальные батчи продолжают
+    отправляться (ScheduledRetryPool, бюджет повторов растет с числом батчей).
+    Сообщения выводятся через report только из вызывающего потока. После
+    неповторяемой ошибки новые батчи не отправляются, а уже начатые и отложенные
+    на повтор доводятся до конца.
+    
+    С journal_scope записанные батчи отмечаются в локальном журнале, и повторный
+    запуск в той же области (сессии) после сбоя не отправляет уже записанные батчи.
+    
+    Args:
+        supabase: Клиент Supabase
+        table_name: Название таблицы
+        records: Список записей
+        upsert_options: Параметры upsert (on_conflict и т.д.)
+        report: Функция (level, message) для вывода сообщений
+        label: Префикс сообщений о батчах
+        max_in_flight: Максимальное число одновременных запросов
+        max_batch_bytes: Максимальный размер тела запроса в байтах
+        journal_scope: Область журнала для возобновления (id сессии; None — без журнала)
+        
+    Returns:
+        Tuple (успех, количество загруженных записей)
+    """
+    batches = list(split_records_by_size(records, max_batch_bytes))
+    journal = open_upload_journal(report) if journal_scope else None
+    if journal is None:
+        return _upsert_batches(supabase, table_name, batches, upsert_options, report, label, max_in_flight)
+    with journal:
+        return _upsert_batches(supabase, table_name, batches, upsert_options, report, label, max_in_flight,
+                               journal, journal_scope)
+
+def _upsert_batches(supabase, table_name: str, batches: List[List[dict]], upsert_options: dict, report, label: str,
+                    max_in_flight: int, journal: Optional[UploadJournal] = None,
+                    journal_scope: Optional[str] = None) -> Tuple[bool, int]:
+    """Отправка батчей для upsert_records_concurrently (с журналом, если он передан)"""
+    total_batches = len(batches)
+    total_processed = 0
+    failed = False
+    batch_keys = upload_key = None
+    batches_to_send = range(total_batches)
+    if journal is not None:
+        batch_keys = [UploadJournal.batch_key(batch) for batch in batches]
+        upload_key = UploadJournal.upload_key(journal_scope, table_name, upsert_options)
+        committed = journal.committed(upload_key, batch_keys)
+        batches_to_send = [batch_idx for batch_idx in range(total_batches) if batch_keys[batch_idx] not in committed]
+        skipped = total_batches - len(batches_to_send)
+        if skipped:
+            total_processed = sum(len(batches[batch_idx]) for batch_idx in range(total_batches) if batch_keys[batch_idx] in committed)
+            report('info', f"⏩ Возобновление загрузки: {skipped}/{total_batches} батчей ({total_processed} записей) уже записаны, отправляются остальные")
+    
+    def report_retry(batch_idx, attempt, error, delay):
+        report('warning', f"⚠️ {label} {batch_idx + 1}/{total_batches}: сбой ({error}), "
+                          f"повтор через {delay:.1f} с (попытка {attempt + 1}/{SUPABASE_RETRY_MAX_ATTEMPTS})")
+    
+    pool = ScheduledRetryPool(min(max_in_flight, total_batches), on_retry=report_retry)
+    for batch_idx in batches_to_send:
+        pool.submit(functools.partial(_send_upsert_batch, supabase, table_name, batches[batch_idx], upsert_options), batch_idx)
+    for batch_idx, _, error, attempts in pool.run():
+        batch_num = batch_idx + 1
+        batch_size = len(batches[batch_idx])
+        if error is not None:
+            if not failed:
+                # Новые батчи больше не отправляются, начатые доводятся до конца
+                failed = True
+                pool.cancel_pending()
+            report('error', f"❌ {label} {batch_num}/{total_batches} не удался: {error}")
+            continue
+        total_processed += batch_size
+        if journal is not None:
+            journal.mark_committed(upload_key, batch_keys[batch_idx], batch_size)
+        suffix = f" (с попытки {attempts})" if attempts > 1 else ""
+        report('success', f"✅ {label} {batch_num}/{total_batches}: обработано {batch_size} записей{suffix}")
+    
+    if journal is not None:
+        if not failed:
+            journal.finish(upload_key, batch_keys)
+        else:
+            report('info', "💾 Записанные батчи сохранены в журнале — повторный запуск продолжит загрузку с места сбоя")
+    return not failed, total_processed
+
+STUDENT_RECORD_FIELDS = [
+    'корпоративная_почта', 'фио', 'филиал_кампус', 'факультет', 'образовательная_программа',
+    'версия_образовательной_программы', 'группа', 'курс'
+]
+
+# Колонки списка студентов -> поля таблицы students (кроме почты и ФИО)
+STUDENT_OPTIONAL_FIELDS = {
+    'филиал_кампус': 'Филиал (кампус)',
+    'факультет': 'Факультет',
+    'образовательная_программа': 'Образовательная программа',
+    'версия_образовательной_программы': 'Версия образовательной программы',
+    'группа': 'Группа',
+    'курс': 'Курс',
+}
+
+def _optional_text_column(df: pd.DataFrame, column: str) -> pd.Series:
+    """Текстовая колонка, где пропуски и пустые строки заменены на None"""
+    if column not in df.columns:
+        return pd.Series([None] * len(df), index=df.index, dtype=object)
+    values = df[column]
+    text = values.astype(str)
+    return text.astype(object).where(values.notna() & (text.str.strip() != ''), None)
+
+def build_student_records(student_data: pd.DataFrame) -> List[dict]:
+    """
+    Подготовка записей таблицы students из списка студентов
+    
+    Записи без корпоративной почты пропускаются, при дубликатах email остается первая.
+    
+    Returns:
+        Список записей для UPSERT
+    """
+    if 'Корпоративная почта' not in student_data.columns:
+        return []
+    emails = student_data['Корпоративная почта'].astype(str).str.strip().str.lower()
+    keep = emails.str.contains('@edu.hse.ru', regex=False) & ~emails.duplicated()
+    if not keep.any():
+        return []
+    df = student_data[keep.values]
+    
+    records = pd.DataFrame({'корпоративная_почта': emails[keep.values]}, index=df.index)
+    if 'ФИО' in df.columns:
+        names = df['ФИО'].astype(str).str.strip()
+        records['фио'] = names.where(df['ФИО'].notna() & (names != ''), 'Неизвестно')
+    else:
+        records['фио'] = 'Неизвестно'
+    for field, column in STUDENT_OPTIONAL_FIELDS.items():
+        records[field] = _optional_text_column(df, column)
+    return records[STUDENT_RECORD_FIELDS].to_dict('records')
+
+def student_record_hash(record: dict) -> str:
+    """Хеш содержимого записи студента (по полям STUDENT_RECORD_FIELDS)"""
+    values = [record.get(field) for field in STUDENT_RECORD_FIELDS]
+    return hashlib.sha1(json.dumps(values, ensure_ascii=False, default=str).encode('utf-8')).hexdigest()
+
+def fetch_student_hashes() -> Dict[str, str]:
+    """
+    Хеши текущих записей таблицы students (один проход по таблице)
+    
+    Returns:
+        Словарь {корпоративная почта: хеш записи}
+    """
+    current_df = read_supabase_table('students', columns=STUDENT_RECORD_FIELDS, key_column='корпоративная_почта')
+    current_df = current_df.astype(object).where(current_df.notna(), None)
+    return {
+        record['корпоративная_почта']: student_record_hash(record)
+        for record in current_df.to_dict('records')
+    }
+
+def compute_student_delta(records: List[dict], existing_hashes: Dict[str, str]) -> Dict[str, object]:
+    """
+    Сравнение подготовленных записей с текущим содержимым таблицы students
+    
+    Args:
+        records: Записи из build_student_records
+        existing_hashes: Хеши записей в базе из fetch_student_hashes
+        
+    Returns:
+        Словарь с ключами new, changed (списки записей) и unchanged (количество)
+    """
+    new_records, changed_records = [], []
+    unchanged = 0
+    for record in records:
+        existing_hash = existing_hashes.get(record['корпоративная_почта'])
+        if existing_hash is None:
+            new_records.append(record)
+        elif existing_hash != student_record_hash(record):
+            changed_records.append(record)
+        else:
+            unchanged += 1
+    return {'new': new_records, 'changed': changed_records, 'unchanged': unchanged}
 
-def upload_students_to_supabase(supabase, student_data):
+def upload_students_to_supabase(supabase, student_data, records: List[dict] = None, journal_scope: Optional[str] = None):
     """
     Загрузка данных студентов в таблицу students с использованием оптимизированного UPSERT
+    
+    records — готовые записи для отправки (например, только новые и измененные
+    из compute_student_delta); по умолчанию строятся из student_data.
+    journal_scope — область журнала для возобновления прерванной загрузки (id сессии).
     """
     try:
         st.info("👥 Загрузка данных студентов (UPSERT)...")
-        records_for_upsert = []
-        processed_emails = set()
-        
-        for _, row in student_data.iterrows():
-            email = str(row.get('Корпоративная почта', '')).strip().lower()
-            if not email or '@edu.hse.ru' not in email:
-                continue
-            if email in processed_emails:
-                continue
-            processed_emails.add(email)
-                
-            student_record = {
-                'корпоративная_почта': email,
-                'фио': str(row.get('ФИО', 'Неизвестно')).strip() or 'Неизвестно',
-                'филиал_кампус': str(row.get('Филиал (кампус)', '')) if pd.notna(row.get('Филиал (кампус)')) and str(row.get('Филиал (кампус)', '')).strip() else None,
-                'факультет': str(row.get('Факультет', '')) if pd.notna(row.get('Факультет')) and str(row.get('Факультет', '')).strip() else None,
-                'образовательная_программа': str(row.get('Образовательная программа', '')) if pd.notna(row.get('Образовательная программа')) and str(row.get('Образовательная программа', '')).strip() else None,
-                'версия_образовательной_программы': str(row.get('Версия образовательной программы', '')) if pd.notna(row.get('Версия образовательной программы')) and str(row.get('Версия образовательной программы', '')).strip() else None,
-                'группа': str(row.get('Группа', '')) if pd.notna(row.get('Группа')) and str(row.get('Группа', '')).strip() else None,
-                'курс': str(row.get('Курс', '')) if pd.notna(row.get('Курс')) and str(row.get('Курс', '')).strip() else None,
-            }
-            records_for_upsert.append(student_record)
+        records_for_upsert = build_student_records(student_data) if records is None else records
         
         if not records_for_upsert:
             st.info("📋 Нет записей для обработки")
             return True
         
         st.info(f"📋 Подготовлено {len(records_for_upsert)} записей для UPSERT")
-        batch_size = 200
-        total_processed = 0
-        
-        for i in range(0, len(records_for_upsert), batch_size):
-            batch = records_for_upsert[i:i + batch_size]
-            batch_num = (i // batch_size) + 1
-            total_batches = ((len(records_for_upsert) - 1) // batch_size) + 1
-            
-            try:
-                result = supabase.table('students').upsert(
-                    batch,
-                    on_conflict='корпоративная_почта',
-                    ignore_duplicates=False,
-                    returning='minimal'
-                ).execute()
-                total_processed += len(batch)
-                st.success(f"✅ Батч {batch_num}/{total_batches}: обработано {len(batch)} записей")
-            except Exception as e:
-                error_str = str(e)
-                if any(pat in error_str.lower() for pat in ["connection", "timeout", "ssl", "eof"]):
-                    st.warning(f"⚠️ Сетевая ошибка в батче {batch_num}, повтор...")
-                    time.sleep(2)
-                    try:
-                        result = supabase.table('students').upsert(batch, on_conflict='корпоративная_почта').execute()
-                        total_processed += len(batch)
-                        st.success(f"✅ Батч {batch_num} (после повтора)")
-                    except Exception as retry_error:
-                        st.error(f"❌ Батч {batch_num} не удался после повтора: {retry_error}")
-                        return False
-                else:
-                    st.error(f"❌ Ошибка в батче {batch_num}: {e}")
-                    return False
+        success, total_processed = upsert_records_concurrently(
+            supabase, 'students', records_for_upsert,
+            {'on_conflict': 'корпоративная_почта', 'ignore_duplicates': False, 'returning': 'minimal'},
+            journal_scope=journal_scope
+        )
+        # Даже частичная запись меняет таблицу — снимки students устарели
+        get_table_snapshot_cache().invalidate('students')
+        if not success:
+            return False
         
         st.success(f"🎉 UPSERT завершён! Обработано {total_processed} записей")
         return True
@@ -1046,258 +2434,263 @@ def upload_students_to_supabase(supabase, student_data):
         st.error(f"❌ Критическая ошибка UPSERT студентов: {e}")
         return False
 
+STUDENT_LIST_COLUMN_ALIASES = {
+    'ФИО': ['фио', 'фio', 'имя', 'name'],
+    'Корпоративная почта': ['адрес электронной почты', 'корпоративная почта', 'email', 'почта', 'e-mail'],
+    'Филиал (кампус)': ['филиал', 'кампус', 'campus'],
+    'Факультет': ['факультет', 'faculty'],
+    'Образовательная программа': ['образовательная программа', 'программа', 'educational program'],
+    'Версия образовательной программы': ['версия образовательной программы', 'версия программы', 'program version', 'version'],
+    'Группа': ['группа', 'group'],
+    'Курс': ['курс', 'course']
+}
+
+def _is_student_list_column(col) -> bool:
+    """Нужна ли колонка файла со списком студентов (остальные не читаются)"""
+    if col == 'Данные о пользователе':
+        return True
+    col_name = str(col).lower().strip()
+    return any(possible_name in col_name for aliases in STUDENT_LIST_COLUMN_ALIASES.values() for possible_name in aliases)
+
+def _normalize_student_list(df: pd.DataFrame) -> pd.DataFrame:
+    """Приведение колонок файла со списком студентов к стандартным названиям"""
+    required_columns = STUDENT_LIST_COLUMN_ALIASES
+
+    found_columns = {}
+    df_columns_lower = [str(col).lower().strip() for col in df.columns]
+    for target_col, possible_names in required_columns.items():
+        for col_idx, col_name in enumerate(df_columns_lower):
+            if any(possible_name in col_name for possible_name in possible_names):
+                found_columns[target_col] = df.columns[col_idx]
+                break
+
+    result_df = pd.DataFrame()
+    for target_col, source_col in found_columns.items():
+        if source_col in df.columns:
+            result_df[target_col] = df[source_col]
+
+    if 'Данные о пользователе' in df.columns:
+        user_data = df['Данные о пользователе'].astype(str)
+        parsed_data = user_data.str.split(';', expand=True)
+        if len(parsed_data.columns) >= 4:
+            result_df['Факультет'] = parsed_data[0]
+            result_df['Образовательная программа'] = parsed_data[1] 
+            result_df['Курс'] = parsed_data[2]
+            result_df['Группа'] = parsed_data[3]
+
+    for required_col in required_columns.keys():
+        if required_col not in result_df.columns:
+            if required_col == 'ФИО':
+                result_df[required_col] = None
+            else:
+                result_df[required_col] = ''
+
+    if 'Корпоративная почта' in result_df.columns:
+        result_df = result_df[result_df['Корпоративная почта'].astype(str).str.contains('@edu.hse.ru', na=False)]
+        result_df['Корпоративная почта'] = pd.Series(result_df['Корпоративная почта']).astype(str).str.lower().str.strip()
+    return result_df
+
 def load_student_list_file(uploaded_file) -> pd.DataFrame:
     """
     Загрузка списка студентов из файла Excel или CSV
+    (результат кэшируется по хэшу содержимого файла)
     """
     try:
         file_name = uploaded_file.name.lower()
-        if file_name.endswith(('.xlsx', '.xls')):
-            df = pd.read_excel(uploaded_file)
-        elif file_name.endswith('.csv'):
-            content = uploaded_file.getvalue()
-            try:
-                df = pd.read_csv(StringIO(content.decode('utf-16')), sep='\t')
-            except (UnicodeDecodeError, pd.errors.ParserError):
-                try:
-                    df = pd.read_csv(StringIO(content.decode('utf-8')))
-                except UnicodeDecodeError:
-                    df = pd.read_csv(StringIO(content.decode('cp1251')))
-        else:
+        if not file_name.endswith(('.xlsx', '.xls', '.csv')):
             st.error("Неподдерживаемый формат файла")
             return pd.DataFrame()
-
-        required_columns = {
-            'ФИО': ['фио', 'фio', 'имя', 'name'],
-            'Корпоративная почта': ['адрес электронной почты', 'корпоративная почта', 'email', 'почта', 'e-mail'],
-            'Филиал (кампус)': ['филиал', 'кампус', 'campus'],
-            'Факультет': ['факультет', 'faculty'],
-            'Образовательная программа': ['образовательная программа', 'программа', 'educational program'],
-            'Версия образовательной программы': ['версия образовательной программы', 'версия программы', 'program version', 'version'],
-            'Группа': ['группа', 'group'],
-            'Курс': ['курс', 'course']
-        }
-
-        found_columns = {}
-        df_columns_lower = [str(col).lower().strip() for col in df.columns]
-        for target_col, possible_names in required_columns.items():
-            for col_idx, col_name in enumerate(df_columns_lower):
-                if any(possible_name in col_name for possible_name in possible_names):
-                    found_columns[target_col] = df.columns[col_idx]
-                    break
-
-        result_df = pd.DataFrame()
-        for target_col, source_col in found_columns.items():
-            if source_col in df.columns:
-                result_df[target_col] = df[source_col]
-
-        if 'Данные о пользователе' in df.columns:
-            user_data = df['Данные о пользователе'].astype(str)
-            parsed_data = user_data.str.split(';', expand=True)
-            if len(parsed_data.columns) >= 4:
-                result_df['Факультет'] = parsed_data[0]
-                result_df['Образовательная программа'] = parsed_data[1] 
-                result_df['Курс'] = parsed_data[2]
-                result_df['Группа'] = parsed_data[3]
-
-        for required_col in required_columns.keys():
-            if required_col not in result_df.columns:
-                if required_col == 'ФИО':
-                    result_df[required_col] = None
-                else:
-                    result_df[required_col] = ''
-
-        if 'Корпоративная почта' in result_df.columns:
-            result_df = result_df[result_df['Корпоративная почта'].astype(str).str.contains('@edu.hse.ru', na=False)]
-            result_df['Корпоративная почта'] = pd.Series(result_df['Корпоративная почта']).astype(str).str.lower().str.strip()
-        return result_df
+        return cached_upload_parse(
+            'student_list', uploaded_file,
+            lambda: _normalize_student_list(parse_table_bytes(uploaded_file.getvalue(), uploaded_file.name, usecols=_is_student_list_column))
+        )
     except Exception as e:
         st.error(f"Ошибка загрузки списка студентов: {e}")
         return pd.DataFrame()
 
-def upload_course_data_to_supabase(supabase, course_data, course_name):
-    """Загрузка данных одного курса в соответствующую таблицу"""
+def build_course_records(course_data: pd.DataFrame, course_name: str) -> List[dict]:
+    """
+    Подготовка записей таблицы курса из DataFrame с процентами завершения
+    
+    Записи без корпоративной почты пропускаются, при дубликатах email остается первая,
+    нечисловые проценты заменяются на None.
+    
+    Returns:
+        Список записей для UPSERT
+    """
+    if 'Корпоративная почта' not in course_data.columns:
+        return []
+    emails = course_data['Корпоративная почта'].astype(str).str.strip().str.lower()
+    keep = (emails.str.contains('@edu.hse.ru', regex=False) & ~emails.duplicated()).values
+    
+    percent_col = f'Процент_{course_name}'
+    if percent_col in course_data.columns:
+        progress = pd.to_numeric(course_data[percent_col][keep], errors='coerce').astype(float)
+        progress = progress.astype(object).where(progress.notna(), None)
+    else:
+        progress = None
+    records = pd.DataFrame({'корпоративная_почта': emails[keep], 'процент_завершения': progress})
+    return records.to_dict('records')
+
+def upload_course_data_to_supabase(supabase, course_data, course_name, report=_st_report, journal_scope: Optional[str] = None):
+    """Загрузка данных одного курса в соответствующую таблицу (report — вывод сообщений, journal_scope — область журнала)"""
     try:
         table_mapping = {'ЦГ': 'course_cg', 'Питон': 'course_python', 'Андан': 'course_analysis'}
         table_name = table_mapping.get(course_name)
         if not table_name:
-            st.error(f"❌ Неизвестный курс: {course_name}")
+            report('error', f"❌ Неизвестный курс: {course_name}")
             return False
             
-        st.info(f"📈 Загрузка курса {course_name} в {table_name}...")
+        report('info', f"📈 Загрузка курса {course_name} в {table_name}...")
         if course_data is None or course_data.empty:
-            st.warning(f"⚠️ Нет данных для курса {course_name}")
+            report('warning', f"⚠️ Нет данных для курса {course_name}")
             return True
 
-        records_for_upsert = []
-        processed_emails = set()
-        
-        for _, row in course_data.iterrows():
-            email = str(row.get('Корпоративная почта', '')).strip().lower()
-            if not email or '@edu.hse.ru' not in email:
-                continue
-            if email in processed_emails:
-                continue
-                
-            processed_emails.add(email)
-            
-            percent_col = f'Процент_{course_name}'
-            progress_value = None
-            if percent_col in row and pd.notna(row[percent_col]) and row[percent_col] != '':
-                try:
-                    progress_value = float(row[percent_col])
-                except (ValueError, TypeError):
-                    progress_value = None
-            
-            records_for_upsert.append({
-                'корпоративная_почта': email,
-                'процент_завершения': progress_value
-            })
+        records_for_upsert = build_course_records(course_data, course_name)
         
         if not records_for_upsert:
-            st.info(f"📋 Нет записей для курса {course_name}")
+            report('info', f"📋 Нет записей для курса {course_name}")
             return True
 
-        batch_size = 200
-        total_processed = 0
-        for i in range(0, len(records_for_upsert), batch_size):
-            batch = records_for_upsert[i:i + batch_size]
-            batch_num = (i // batch_size) + 1
-            try:
-                supabase.table(table_name).upsert(batch, on_conflict='корпоративная_почта').execute()
-                total_processed += len(batch)
-                st.success(f"✅ Курс {course_name} - батч {batch_num}: {len(batch)} записей")
-            except Exception as e:
-                st.error(f"❌ Ошибка загрузки курса {course_name}, батч {batch_num}: {e}")
-                return False
+        success, total_processed = upsert_records_concurrently(
+            supabase, table_name, records_for_upsert, {'on_conflict': 'корпоративная_почта'},
+            report=report, label=f"Курс {course_name} - батч", journal_scope=journal_scope
+        )
+        if not success:
+            return False
 
-        st.success(f"🎉 Курс {course_name}: {total_processed} записей загружено")
+        report('success', f"🎉 Курс {course_name}: {total_processed} записей загружено")
         return True
     except Exception as e:
-        st.error(f"❌ Ошибка загрузки курса {course_name}: {e}")
+        report('error', f"❌ Ошибка загрузки курса {course_name}: {e}")
         return False
 
-def extract_course_data(uploaded_file, course_name):
-    """Извлечение данных курса из файла"""
-    try:
-        file_name = uploaded_file.name.lower()
-        if file_name.endswith(('.xlsx', '.xls')):
-            df = pd.read_excel(uploaded_file)
-        elif file_name.endswith('.csv'):
-            content = uploaded_file.getvalue()
-            try:
-                df = pd.read_csv(StringIO(content.decode('utf-16')), sep='\t')
-            except (UnicodeDecodeError, pd.errors.ParserError):
-                try:
-                    df = pd.read_csv(StringIO(content.decode('utf-8')))
-                except UnicodeDecodeError:
-                    df = pd.read_csv(StringIO(content.decode('cp1251')))
+def extract_courses_parallel(course_files: Dict[str, object], on_course_done=None) -> Dict[str, Optional[pd.DataFrame]]:
+    """
+    Параллельный разбор файлов курсов в пуле процессов
+    
+    Результаты расчета хранятся в кэше загрузок по хэшу содержимого файла,
+    поэтому повторная обработка тех же файлов не разбирает их заново.
+    
+    Args:
+        course_files: Словарь {название курса: загруженный файл}
+        on_course_done: Функция (курс, результат, сообщения), вызываемая по готовности курса
+        
+    Returns:
+        Словарь {название курса: DataFrame с процентами или None}
+    """
+    cache = get_upload_cache()
+    owner = upload_cache_owner()
+    results = {}
+    cache_keys = {}
+    
+    for course_name, uploaded_file in course_files.items():
+        cache_keys[course_name] = upload_cache_key('course', uploaded_file, course_name)
+        cached_df = cache.get(cache_keys[course_name], owner)
+        if cached_df is not None:
+            results[course_name] = cached_df
+            if on_course_done:
+                on_course_done(course_name, cached_df, [
+                    ('success', f"✅ Курс {course_name}: результат расчета взят из кэша ({len(cached_df)} студентов)")
+                ])
+    
+    course_names = [name for name in course_files if name not in results]
+    tasks = [(course_files[name].name, course_files[name].getvalue(), name) for name in course_names]
+    
+    for idx, outcome, error in run_in_process_pool(extract_course_worker, tasks):
+        course_name = course_names[idx]
+        if error is not None:
+            result_df, messages = None, [('error', f"Ошибка обработки данных курса {course_name}: {error}")]
         else:
-            st.error(f"Неподдерживаемый формат файла для курса {course_name}")
-            return None
-
-        email_column = None
-        possible_email_names = ['Адрес электронной почты', 'Корпоративная почта', 'Email', 'Почта', 'E-mail']
-        for col_name in possible_email_names:
-            if col_name in df.columns:
-                email_column = col_name
-                break
-        if email_column is None:
-            st.error(f"Столбец с email не найден в файле {course_name}")
-            return None
-
-        cg_excluded_keywords = [
-            'take away', 'шпаргалка', 'консультация', 'общая информация', 'промо-ролик',
-            'поддержка студентов', 'пояснение', 'случайный вариант для студентов с овз',
-            'материалы по модулю', 'копия', 'демонстрационный вариант', 'спецификация',
-            'демо-версия', 'правила проведения независимого экзамена',
-            'порядок организации и проведения независимых экзаменов',
-            'интерактивный тренажер правил нэ', 'пересдачи в сентябре', 'незрячих и слабовидящих',
-            'проекты с использование tei', 'тренировочный тест', 'ключевые принципы tei',
-            'базовые возможности tie', 'специальные модули tei', 'будут идентичными',
-            'опрос', 'тест по модулю', 'анкета', 'user information', 'страна', 'user_id', 'данные о пользователе'
-        ]
+            result_df, messages = outcome
+        if result_df is not None:
+            cache.put(cache_keys[course_name], result_df, owner)
+            result_df = result_df.copy()
+        results[course_name] = result_df
+        if on_course_done:
+            on_course_done(course_name, result_df, messages)
+    return results
+
+# Студенты, по которым загружается аналитика курсов (фильтр выполняется в Supabase)
+COURSE_ANALYTICS_LEVELS = ['Бакалавриат', 'Специалитет']
+COURSE_ANALYTICS_COURSES = ['Курс 1', 'Курс 2', 'Курс 3', 'Курс 4']
+
+def load_course_analytics_emails() -> Optional[set]:
+    """
+    Почты студентов бакалавриата и специалитета 1–4 курсов из таблицы students
+    
+    Из базы запрашивается только колонка почты с фильтрами по уровню и курсу.
+    
+    Returns:
+        Множество почт или None, если список студентов получить не удалось
+    """
+    students_df = load_students_from_supabase(
+        courses=COURSE_ANALYTICS_COURSES, levels=COURSE_ANALYTICS_LEVELS, columns=['корпоративная_почта']
+    )
+    if students_df.empty:
+        return None
+    return set(students_df['Адрес электронной почты'].astype(str).str.strip().str.lower())
 
-        excluded_count = 0
-        completed_columns = []
-        timestamp_columns = []
-
-        for col in df.columns:
-            if col not in ['Unnamed: 0', email_column, 'Данные о пользователе', 'User information', 'Страна']:
-                if course_name == 'ЦГ':
-                    should_exclude = False
-                    col_str = str(col).strip().lower()
-                    for excluded_keyword in cg_excluded_keywords:
-                        if excluded_keyword.lower() in col_str:
-                            should_exclude = True
-                            excluded_count += 1
-                            break
-                    if should_exclude:
-                        continue
+def filter_course_data_by_emails(course_data: pd.DataFrame, allowed_emails: set) -> pd.DataFrame:
+    """Строки данных курса, почта которых входит в allowed_emails"""
+    emails = course_data['Корпоративная почта'].astype(str).str.strip().str.lower()
+    return course_data[emails.isin(allowed_emails)]
 
-                if not col.startswith('Unnamed:') and len(str(col).strip()) > 0:
-                    sample_values = df[col].dropna().astype(str).head(100)
-                    if any('Выполнено' in str(val) or 'выполнено' in str(val).lower() for val in sample_values):
-                        if not all(str(val) == 'Не выполнено' for val in sample_values if pd.notna(val)):
-                            completed_columns.append(col)
-                elif col.startswith('Unnamed:') and col != 'Unnamed: 0':
-                    sample_values = df[col].dropna().astype(str).head(20)
-                    for val in sample_values:
-                        val_str = str(val).strip()
-                        if any(pattern in val_str for pattern in ['2020', '2021', '2022', '2023', '2024']) and ':' in val_str:
-                            timestamp_columns.append(col)
-                            break
-
-        if timestamp_columns:
-            completion_data = []
-            for idx, row in df.iterrows():
-                email_val = row[email_column]
-                if pd.isna(email_val) or '@edu.hse.ru' not in str(email_val).lower():
-                    continue
-                total_tasks = len(timestamp_columns)
-                completed_tasks = 0
-                for col in timestamp_columns:
-                    cell_val = row[col]
-                    val_str = str(cell_val).strip() if not pd.isna(cell_val) else ''
-                    if val_str and val_str != 'nan' and val_str != '':
-                        if any(pattern in val_str for pattern in ['2020', '2021', '2022', '2023', '2024']) and ':' in val_str:
-                            completed_tasks += 1
-                percentage = (completed_tasks / total_tasks * 100) if total_tasks > 0 else 0
-                completion_data.append({'email': str(email_val).lower().strip(), 'percentage': percentage})
-            if completion_data:
-                result_df = pd.DataFrame(completion_data)
-                result_df.columns = ['Корпоративная почта', f'Процент_{course_name}']
-                st.success(f"✅ Рассчитан процент завершения для {len(result_df)} студентов курса {course_name}")
-                return result_df
-
-        elif completed_columns:
-            completion_data = []
-            for idx, row in df.iterrows():
-                email_val = row[email_column]
-                if pd.isna(email_val) or '@edu.hse.ru' not in str(email_val).lower():
-                    continue
-                total_tasks = 0
-                completed_tasks = 0
-                for col in completed_columns:
-                    cell_val = row[col]
-                    val = str(cell_val).strip() if not pd.isna(cell_val) else ''
-                    if val and val != 'nan':
-                        total_tasks += 1
-                        if 'Выполнено' in val or 'выполнено' in val.lower():
-                            completed_tasks += 1
-                percentage = (completed_tasks / total_tasks * 100) if total_tasks > 0 else 0
-                completion_data.append({'email': str(email_val).lower().strip(), 'percentage': percentage})
-            if completion_data:
-                result_df = pd.DataFrame(completion_data)
-                result_df.columns = ['Корпоративная почта', f'Процент_{course_name}']
-                st.success(f"✅ Рассчитан процент завершения для {len(result_df)} студентов курса {course_name}")
-                return result_df
-
-        st.warning(f"Не найдено данных о завершении для курса {course_name}")
-        return None
-    except Exception as e:
-        st.error(f"Ошибка обработки данных курса {course_name}: {e}")
-        return None
+def upload_courses_concurrently(supabase, course_data: Dict[str, pd.DataFrame], on_report=None, on_course_done=None,
+                                journal_scope: Optional[str] = None) -> Dict[str, bool]:
+    """
+    Одновременная загрузка курсов в Supabase (по потоку на курс)
+    
+    Сообщения из потоков передаются через очередь и выводятся в основном потоке
+    скрипта — вызывать Streamlit из рабочих потоков нельзя.
+    
+    Args:
+        supabase: Клиент Supabase
+        course_data: Словарь {название курса: DataFrame с процентами}
+        on_report: Функция (курс, level, message) для вывода сообщений
+        on_course_done: Функция (курс, успех), вызываемая по завершении курса
+        journal_scope: Область журнала для возобновления (id сессии; None — без журнала)
+        
+    Returns:
+        Словарь {название курса: успех загрузки}
+    """
+    report_queue = queue.Queue()
+    
+    def drain_reports():
+        while True:
+            try:
+                course_name, level, message = report_queue.get_nowait()
+            except queue.Empty:
+                return
+            if on_report:
+                on_report(course_name, level, message)
+    
+    def make_reporter(course_name):
+        return lambda level, message: report_queue.put((course_name, level, message))
+    
+    results = {}
+    with ThreadPoolExecutor(max_workers=max(1, len(course_data))) as executor:
+        futures = {
+            executor.submit(upload_course_data_to_supabase, supabase, data, course_name, make_reporter(course_name),
+                            journal_scope): course_name
+            for course_name, data in course_data.items()
+        }
+        pending = set(futures)
+        while pending:
+            done, pending = wait(pending, timeout=0.2, return_when=FIRST_COMPLETED)
+            drain_reports()
+            for future in done:
+                course_name = futures[future]
+                try:
+                    results[course_name] = future.result()
+                except Exception as e:
+                    if on_report:
+                        on_report(course_name, 'error', f"❌ Ошибка загрузки курса {course_name}: {e}")
+                    results[course_name] = False
+                if on_course_done:
+                    on_course_done(course_name, results[course_name])
+    drain_reports()
+    return results
 
 # =============================================================================
 # ОСНОВНОЕ ПРИЛОЖЕНИЕ
@@ -1364,6 +2757,14 @@ def main():
             unsafe_allow_html=True
         )
         
+        # Формат файлов для кнопок скачивания (собирается только выбранный)
+        st.selectbox(
+            "Формат выгрузки",
+            available_export_formats(),
+            format_func=lambda fmt: EXPORT_FORMATS[fmt][0],
+            key="export_format"
+        )
+        
         st.markdown("<hr class='sidebar-divider'>", unsafe_allow_html=True)
         
         # Быстрые действия
@@ -1430,6 +2831,56 @@ def main():
                     unsafe_allow_html=True
                 )
         
+        # Метрики кэша разобранных загрузок
+        with st.expander("🗄️ Кэш загрузок", expanded=False):
+            cache_stats = get_upload_cache().stats(upload_cache_owner())
+            total_requests = cache_stats['hits'] + cache_stats['misses']
+            hit_rate = cache_stats['hits'] / total_requests * 100 if total_requests else 0
+            st.markdown(
+                f"""
+                <div style='font-size: 0.8rem; line-height: 1.8;'>
+                <div style='display: flex; justify-content: space-between;'>
+                    <span style='color: var(--apple-text-secondary);'>Файлов в кэше (ваших):</span>
+                    <strong>{cache_stats['entries']} ({cache_stats['owner_entries']})</strong>
+                </div>
+                <div style='display: flex; justify-content: space-between;'>
+                    <span style='color: var(--apple-text-secondary);'>Память:</span>
+                    <strong>{cache_stats['bytes'] / 1024 / 1024:.1f} / {cache_stats['max_bytes'] / 1024 / 1024:.0f} МБ</strong>
+                </div>
+                <div style='display: flex; justify-content: space-between;'>
+                    <span style='color: var(--apple-text-secondary);'>Попадания / промахи:</span>
+                    <strong>{cache_stats['hits']} / {cache_stats['misses']} ({hit_rate:.0f}%)</strong>
+                </div>
+                <div style='display: flex; justify-content: space-between;'>
+                    <span style='color: var(--apple-text-secondary);'>Вытеснено:</span>
+                    <strong>{cache_stats['evictions']}</strong>
+                </div>
+                </div>
+                """,
+                unsafe_allow_html=True
+            )
+            snapshot_stats = get_table_snapshot_cache().stats()
+            st.markdown(
+                f"""
+                <div style='font-size: 0.8rem; line-height: 1.8;'>
+                <div style='display: flex; justify-content: space-between;'>
+                    <span style='color: var(--apple-text-secondary);'>Снимков таблиц:</span>
+                    <strong>{snapshot_stats['entries']} (TTL {TABLE_SNAPSHOT_TTL_SECONDS // 60} мин)</strong>
+                </div>
+                <div style='display: flex; justify-content: space-between;'>
+                    <span style='color: var(--apple-text-secondary);'>Попадания / промахи:</span>
+                    <strong>{snapshot_stats['hits']} / {snapshot_stats['misses']}</strong>
+                </div>
+                </div>
+                """,
+                unsafe_allow_html=True
+            )
+            if st.button("Очистить кэш", use_container_width=True, key="clear_upload_cache_btn",
+                         help="Сбрасывает файлы этой сессии; файлы, открытые другими пользователями, остаются в кэше"):
+                get_upload_cache().clear(upload_cache_owner())
+                get_table_snapshot_cache().invalidate('students')
+                st.rerun()
+        
         st.markdown("<hr class='sidebar-divider'>", unsafe_allow_html=True)
         
         # Информация о платформе
@@ -1475,11 +2926,59 @@ def main():
         - Внешнее измерение цифровых компетенций (Входной, Промежуточный, Итоговый контроль)
         """)
         
-        uploaded_file = st.file_uploader(
-            "Выберите файл для обработки",
-            type=['xlsx', 'csv'],
-            key="grade_file"
+        upload_mode = st.radio(
+            "Режим загрузки:",
+            ("Один файл", "Пакетный режим"),
+            horizontal=True,
+            help="""
+            - **Один файл**: обработка одного Excel или CSV файла.
+            - **Пакетный режим**: несколько файлов или ZIP-архив, обработка параллельно, один общий отчет.
+            """
         )
+        batch_mode = (upload_mode == "Пакетный режим")
+
+        if batch_mode:
+            uploaded_files = st.file_uploader(
+                "Выберите файлы или ZIP-архив для обработки",
+                type=['xlsx', 'csv', 'zip'],
+                accept_multiple_files=True,
+                key="grade_files_batch"
+            )
+            uploaded_file = None
+        else:
+            uploaded_file = st.file_uploader(
+                "Выберите файл для обработки",
+                type=['xlsx', 'csv'],
+                key="grade_file"
+            )
+            uploaded_files = []
+
+        with st.expander("⚙️ Правила перезачета"):
+            st.markdown("""
+            Пороги и порядок правил задаются JSON-таблицей. Скачайте текущие правила,
+            измените их и загрузите обратно — правка кода не требуется.
+            """)
+            st.download_button(
+                label="Скачать правила по умолчанию (JSON)",
+                data=json.dumps(DEFAULT_GRADE_RULES, ensure_ascii=False, indent=2).encode('utf-8'),
+                file_name="правила_перезачета.json",
+                mime="application/json",
+                key="grade_rules_download"
+            )
+            rules_file = st.file_uploader(
+                "Загрузите собственные правила (JSON)",
+                type=['json'],
+                key="grade_rules_file"
+            )
+
+        grade_rules = None
+        if rules_file is not None:
+            try:
+                grade_rules = load_grade_rules(rules_file.getvalue())
+                st.success("✅ Используются загруженные правила перезачета")
+            except ValueError as e:
+                st.error(f"❌ Ошибка в файле правил: {e}")
+                st.stop()
 
         if uploaded_file is not None:
             file_name = uploaded_file.name
@@ -1496,38 +2995,89 @@ def main():
             if st.button("Обработать файл", type="primary"):
                 with st.spinner("Обработка данных..."):
                     try:
-                        if file_name.endswith('.xlsx'):
-                            df_initial = pd.read_excel(uploaded_file, engine='openpyxl')
-                        else:
-                            df_initial = pd.read_csv(uploaded_file)
+                        df_initial = read_uploaded_table(uploaded_file, detect_encoding=False)
 
                         use_dynamics_flag = (processing_mode == "Перезачет С динамикой")
-                        result_df = process_grade_recalculation(df_initial, use_dynamics=use_dynamics_flag)
+                        result_df = process_grade_recalculation(df_initial, use_dynamics=use_dynamics_flag, rules=grade_rules)
                         
                         st.success("✅ Обработка успешно завершена!")
                         
                         st.subheader("📊 Предварительный просмотр")
                         st.dataframe(result_df.head(10), use_container_width=True)
 
-                        output = io.BytesIO()
-                        with pd.ExcelWriter(output, engine='xlsxwriter') as writer:
-                            result_df.to_excel(writer, index=False, sheet_name='Результат')
-                        excel_data = output.getvalue()
-
                         current_date = datetime.now().strftime('%d-%m-%y')
-                        download_filename = f"Результат_{file_name.split('.')[0]}_{current_date}.xlsx"
-                        
-                        st.download_button(
+                        render_download_button(
+                            {'Результат': result_df},
+                            file_stem=f"Результат_{file_name.split('.')[0]}_{current_date}",
                             label="Скачать результат",
-                            data=excel_data,
-                            file_name=download_filename,
-                            mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+                            key="download_grades"
                         )
 
                     except KeyError as e:
                         st.error(f"❌ Ошибка в структуре файла: {e}")
                     except Exception as e:
                         st.error(f"❌ Произошла ошибка: {e}")
+
+        if uploaded_files:
+            processing_mode = st.radio(
+                "Режим обработки:",
+                ("Перезачет БЕЗ динамики", "Перезачет С динамикой"),
+                key="batch_processing_mode",
+                help="""
+                - **БЕЗ динамики**: Стандартный перезачет по максимальной оценке.
+                - **С динамикой**: Если оценка падает более чем на 1 балл между этапами, перезачет блокируется.
+                """
+            )
+
+            if st.button("Обработать файлы", type="primary", key="process_batch_btn"):
+                try:
+                    batch_files = expand_batch_uploads(uploaded_files)
+                except zipfile.BadZipFile as e:
+                    st.error(f"❌ Не удалось распаковать архив: {e}")
+                    st.stop()
+
+                if not batch_files:
+                    st.warning("⚠️ Не найдено файлов .xlsx или .csv для обработки")
+                    st.stop()
+
+                st.info(f"📂 Файлов к обработке: {len(batch_files)}")
+                progress_bar = st.progress(0.0)
+
+                def update_batch_progress(done, total):
+                    progress_bar.progress(done / total, text=f"Обработано файлов: {done} из {total}")
+
+                try:
+                    use_dynamics_flag = (processing_mode == "Перезачет С динамикой")
+                    combined_df, summary_df = process_grade_recalculation_batch(
+                        batch_files,
+                        use_dynamics=use_dynamics_flag,
+                        rules=grade_rules,
+                        progress_callback=update_batch_progress
+                    )
+
+                    failed_count = int((summary_df['Статус'] == 'Ошибка').sum())
+                    if failed_count:
+                        st.warning(f"⚠️ Обработано {len(batch_files) - failed_count} из {len(batch_files)} файлов, с ошибками: {failed_count}")
+                    else:
+                        st.success(f"✅ Все {len(batch_files)} файлов успешно обработаны!")
+
+                    st.subheader("📋 Сводка по файлам")
+                    st.dataframe(summary_df, use_container_width=True)
+
+                    if not combined_df.empty:
+                        st.subheader("📊 Предварительный просмотр")
+                        st.dataframe(combined_df.head(10), use_container_width=True)
+
+                        current_date = datetime.now().strftime('%d-%m-%y')
+                        render_download_button(
+                            {'Результат': combined_df, 'Сводка': summary_df},
+                            file_stem=f"Результат_пакет_{current_date}",
+                            label="Скачать объединенный результат",
+                            key="download_batch"
+                        )
+
+                except Exception as e:
+                    st.error(f"❌ Произошла ошибка: {e}")
     
     # =============================================================================
     # МОДУЛЬ 2: ГЕНЕРАТОР HTML-КАРТОЧЕК
@@ -1755,7 +3305,7 @@ def main():
         if excel_file and skills_file:
             try:
                 with st.spinner("📥 Загрузка файлов..."):
-                    df = pd.read_excel(excel_file)
+                    df = read_uploaded_table(excel_file)
                     skills_content = skills_file.read()
                     grade_mapping = load_reference_data(skills_content)
                 
@@ -1781,16 +3331,11 @@ def main():
                     st.subheader("📊 Результаты")
                     st.dataframe(result_df, use_container_width=True)
                     
-                    output = io.BytesIO()
-                    with pd.ExcelWriter(output, engine='openpyxl', mode='w') as writer:
-                        result_df.to_excel(writer, index=False)
-                    output.seek(0)
-                    
-                    st.download_button(
+                    render_download_button(
+                        {'Sheet1': result_df},
+                        file_stem="Сертификаты_с_результатами",
                         label="📥 Скачать результаты",
-                        data=output.getvalue(),
-                        file_name="Сертификаты_с_результатами.xlsx",
-                        mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+                        key="download_certificates"
                     )
             
             except Exception as e:
@@ -1846,13 +3391,15 @@ def main():
         if grades_file:
             try:
                 with st.spinner("📥 Загрузка файла с оценками..."):
-                    grades_df = pd.read_excel(grades_file)
+                    grades_df = read_uploaded_table(grades_file, usecols=_is_external_assessment_column)
                 
                 st.success("✅ Файл с оценками успешно загружен!")
                 
                 # Загрузка студентов из Supabase ТОЛЬКО после загрузки файла
                 with st.spinner("📥 Загрузка списка студентов из Supabase..."):
-                    students_df = load_students_from_supabase()
+                    students_df = load_students_from_supabase(
+                        courses=['Курс 4'], columns=EXTERNAL_ASSESSMENT_STUDENT_FIELDS, as_categories=True
+                    )
                 
                 if students_df.empty:
                     st.error("❌ Список студентов пуст. Загрузите данные в таблицу `students` в Supabase.")
@@ -1888,10 +3435,19 @@ def main():
                             else:
                                 st.success("✅ Обработка успешно завершена!")
                                 
+                                # Снимок существующих ключей до вставки — общий для сохранения и вкладки новых записей
+                                try:
+                                    existing_keys = fetch_existing_peresdachi_keys(result_df)
+                                except Exception as e:
+                                    st.warning(f"⚠️ Не удалось получить существующие записи peresdachi: {str(e)}")
+                                    existing_keys = None
+                                new_records_df = get_new_records(result_df, existing_keys)
+                                new_count, total_count = len(new_records_df), len(result_df)
+                                
                                 # Сохранение в Supabase
                                 with st.spinner("💾 Сохранение в Supabase..."):
                                     try:
-                                        new_count, total_count = save_to_supabase(result_df)
+                                        new_count, total_count = save_to_supabase(result_df, existing_keys)
                                         st.success(f"✅ Сохранено в Supabase: {new_count} новых записей из {total_count}")
                                     except Exception as e:
                                         st.error(f"❌ Ошибка при сохранении: {str(e)}")
@@ -1907,9 +3463,6 @@ def main():
                                     existing_count = total_count - new_count
                                     st.metric("Уже существовало", existing_count)
                                 
-                                # Получение новых записей для отображения
-                                new_records_df = get_new_records(result_df)
-                                
                                 # Предпросмотр данных
                                 tab1, tab2 = st.tabs(["📋 Все обработанные данные", "🆕 Только новые записи"])
                                 
@@ -1917,19 +3470,11 @@ def main():
                                     st.dataframe(result_df, use_container_width=True)
                                     
                                     # Экспорт всех данных
-                                    output_all = io.BytesIO()
-                                    with pd.ExcelWriter(output_all, engine='openpyxl') as writer:
-                                        result_df.to_excel(writer, index=False, sheet_name='Все пересдачи')
-                                    output_all.seek(0)
-                                    
                                     current_date = datetime.now().strftime('%d-%m-%Y')
-                                    download_filename_all = f"Пересдачи_все_{current_date}.xlsx"
-                                    
-                                    st.download_button(
-                                        label="Скачать все записи (XLSX)",
-                                        data=output_all.getvalue(),
-                                        file_name=download_filename_all,
-                                        mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+                                    render_download_button(
+                                        {'Все пересдачи': result_df},
+                                        file_stem=f"Пересдачи_все_{current_date}",
+                                        label="Скачать все записи",
                                         key="download_all"
                                     )
                                 
@@ -1940,18 +3485,10 @@ def main():
                                         st.dataframe(new_records_df, use_container_width=True)
                                         
                                         # Экспорт только новых
-                                        output_new = io.BytesIO()
-                                        with pd.ExcelWriter(output_new, engine='openpyxl') as writer:
-                                            new_records_df.to_excel(writer, index=False, sheet_name='Новые пересдачи')
-                                        output_new.seek(0)
-                                        
-                                        download_filename_new = f"Пересдачи_новые_{current_date}.xlsx"
-                                        
-                                        st.download_button(
-                                            label="Скачать только новые записи (XLSX)",
-                                            data=output_new.getvalue(),
-                                            file_name=download_filename_new,
-                                            mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+                                        render_download_button(
+                                            {'Новые пересдачи': new_records_df},
+                                            file_stem=f"Пересдачи_новые_{current_date}",
+                                            label="Скачать только новые записи",
                                             key="download_new"
                                         )
                                 
@@ -2017,7 +3554,8 @@ def main():
             
             # Показываем текущее состояние базы данных
             with st.expander("📊 Текущее состояние базы данных"):
-                existing_peresdachi = load_existing_peresdachi()
+                # Для подсчета и предпросмотра достаточно ключевых колонок
+                existing_peresdachi = load_existing_peresdachi(columns=PERESDACHI_KEY_COLUMNS)
                 if existing_peresdachi.empty:
                     st.info("ℹ️ Таблица peresdachi пуста или не создана")
                 else:
@@ -2082,28 +3620,84 @@ def main():
         else:
             st.success("✅ Все файлы загружены! Готово к обработке.")
             
+            filter_students = st.checkbox(
+                "Только студенты бакалавриата и специалитета 1–4 курсов",
+                value=False,
+                key="course_students_filter",
+                help="Список студентов берется из таблицы students с фильтром на стороне Supabase "
+                     "по колонкам «курс» и «уровень_образования» — студенты без заполненного уровня исключаются"
+            )
+            
             if st.button("🚀 Обработать курсы", type="primary", key="process_courses_btn"):
                 with st.spinner("🔄 Обработка данных..."):
                     try:
-                        st.info("📊 Обработка файлов курсов...")
+                        st.info("📊 Обработка файлов курсов (параллельно)...")
                         course_names = ['ЦГ', 'Питон', 'Андан']
-                        course_files = [course_cg_file, course_python_file, course_analysis_file]
-                        course_data_list = []
+                        course_files = dict(zip(course_names, [course_cg_file, course_python_file, course_analysis_file]))
                         
-                        for course_file, course_name in zip(course_files, course_names):
-                            course_data = extract_course_data(course_file, course_name)
+                        # Отдельный блок прогресса для каждого курса
+                        status_columns = st.columns(len(course_names))
+                        course_status = {}
+                        for status_column, course_name in zip(status_columns, course_names):
+                            with status_column:
+                                course_status[course_name] = st.status(f"⏳ {course_name}: обработка файла...", expanded=False)
+                        
+                        def show_course_report(course_name, level, message):
+                            with course_status[course_name]:
+                                _st_report(level, message)
+                        
+                        def on_course_extracted(course_name, course_data, messages):
+                            for level, message in messages:
+                                show_course_report(course_name, level, message)
                             if course_data is None:
-                                st.error(f"❌ Ошибка обработки курса {course_name}")
+                                course_status[course_name].update(label=f"❌ {course_name}: ошибка обработки", state="error")
+                            else:
+                                course_status[course_name].update(label=f"✅ {course_name}: {len(course_data)} записей", state="running")
+                        
+                        course_data_by_name = extract_courses_parallel(course_files, on_course_done=on_course_extracted)
+                        
+                        failed_courses = [name for name in course_names if course_data_by_name.get(name) is None]
+                        if failed_courses:
+                            st.error(f"❌ Ошибка обработки курсов: {', '.join(failed_courses)}")
+                            st.stop()
+                        
+                        if filter_students:
+                            allowed_emails = load_course_analytics_emails()
+                            if allowed_emails is None:
+                                st.error("❌ Фильтр студентов не вернул ни одного студента (проверьте, что в таблице students "
+                                         "заполнены «курс» и «уровень_образования») — загрузка остановлена")
                                 st.stop()
-                            course_data_list.append(course_data)
-                            st.success(f"✅ Обработан курс {course_name}: {len(course_data)} записей")
+                            excluded_rows = 0
+                            for name in course_names:
+                                filtered_data = filter_course_data_by_emails(course_data_by_name[name], allowed_emails)
+                                excluded_rows += len(course_data_by_name[name]) - len(filtered_data)
+                                course_data_by_name[name] = filtered_data
+                            if all(course_data_by_name[name].empty for name in course_names):
+                                st.error("❌ После фильтра студентов в данных курсов не осталось записей — загрузка остановлена")
+                                st.stop()
+                            st.info(f"🎓 Фильтр студентов: {len(allowed_emails)} студентов бакалавриата и специалитета 1–4 курсов, "
+                                    f"исключено строк курсов: {excluded_rows}")
+                        course_data_list = [course_data_by_name[name] for name in course_names]
                         
-                        # Загрузка в Supabase
+                        # Загрузка в Supabase — все курсы одновременно
                         st.info("💾 Обновление данных курсов в Supabase...")
-                        success_count = 0
-                        for course_data, course_name in zip(course_data_list, course_names):
-                            if upload_course_data_to_supabase(supabase, course_data, course_name):
-                                success_count += 1
+                        for course_name in course_names:
+                            course_status[course_name].update(label=f"💾 {course_name}: загрузка в Supabase...", state="running")
+                        
+                        def on_course_uploaded(course_name, success):
+                            if success:
+                                course_status[course_name].update(label=f"✅ {course_name}: загружено", state="complete")
+                            else:
+                                course_status[course_name].update(label=f"❌ {course_name}: ошибка загрузки", state="error", expanded=True)
+                        
+                        upload_results = upload_courses_concurrently(
+                            supabase,
+                            course_data_by_name,
+                            on_report=show_course_report,
+                            on_course_done=on_course_uploaded,
+                            journal_scope=upload_cache_owner()
+                        )
+                        success_count = sum(1 for success in upload_results.values() if success)
                         
                         if success_count == len(course_names):
                             st.success(f"🎉 Все {success_count} курса успешно загружены!")
@@ -2243,19 +3837,55 @@ def main():
                 with st.expander("👀 Предпросмотр данных"):
                     st.dataframe(students_df.head(20), use_container_width=True)
                 
-                # Кнопка обработки
-                if st.button("Обновить список студентов в Supabase", type="primary", key="update_students_btn"):
-                    with st.spinner("🔄 Обновление базы данных..."):
+                # Сравнение с базой: отправляются только новые и измененные записи
+                file_key = get_upload_cache().content_hash(students_file)
+                delta = st.session_state.get('students_delta')
+                if delta is not None and delta['file_key'] != file_key:
+                    delta = None
+                
+                if st.button("🔍 Сравнить с базой", key="students_delta_btn"):
+                    with st.spinner("🔄 Сравнение с текущей таблицей students..."):
                         try:
-                            if upload_students_to_supabase(supabase, students_df):
-                                st.success("✅ Список студентов обновлён!")
-                                st.balloons()
-                            else:
-                                st.error("❌ Не удалось обновить список студентов")
-                            
+                            records = build_student_records(students_df)
+                            delta = compute_student_delta(records, fetch_student_hashes())
+                            delta['file_key'] = file_key
+                            st.session_state['students_delta'] = delta
                         except Exception as e:
-                            st.error(f"❌ Ошибка при обновлении: {str(e)}")
-                            st.exception(e)
+                            st.error(f"❌ Ошибка при сравнении с базой: {str(e)}")
+                            delta = None
+                
+                if delta is None:
+                    st.info("ℹ️ Нажмите «Сравнить с базой», чтобы увидеть, какие записи изменятся")
+                else:
+                    col1, col2, col3 = st.columns(3)
+                    with col1:
+                        st.metric("Новых", len(delta['new']))
+                    with col2:
+                        st.metric("Изменённых", len(delta['changed']))
+                    with col3:
+                        st.metric("Без изменений", delta['unchanged'])
+                    
+                    if delta['changed']:
+                        with st.expander("✏️ Изменённые записи"):
+                            st.dataframe(pd.DataFrame(delta['changed']).head(100), use_container_width=True)
+                    
+                    records_to_send = delta['new'] + delta['changed']
+                    if not records_to_send:
+                        st.success("✅ Таблица students уже актуальна — отправлять нечего")
+                    elif st.button("Обновить список студентов в Supabase", type="primary", key="update_students_btn"):
+                        with st.spinner("🔄 Обновление базы данных..."):
+                            try:
+                                if upload_students_to_supabase(supabase, students_df, records=records_to_send,
+                                                               journal_scope=upload_cache_owner()):
+                                    st.session_state.pop('students_delta', None)
+                                    st.success("✅ Список студентов обновлён!")
+                                    st.balloons()
+                                else:
+                                    st.error("❌ Не удалось обновить список студентов")
+                                
+                            except Exception as e:
+                                st.error(f"❌ Ошибка при обновлении: {str(e)}")
+                                st.exception(e)
             
             except Exception as e:
                 st.error(f"❌ Ошибка при загрузке файла: {str(e)}")
@@ -2273,7 +3903,8 @@ def main():
             2. **Убедитесь**, что файл содержит необходимые колонки
             3. **Загрузите файл** через форму выше
             4. **Проверьте предпросмотр** данных
-            5. **Нажмите кнопку "Обновить"**
+            5. **Нажмите "Сравнить с базой"** — будут показаны новые, изменённые и неизменные записи
+            6. **Нажмите кнопку "Обновить"** — отправляются только новые и изменённые записи
             
             **Важно:**
             - ✅ Дубликаты по email автоматически удаляются
@@ -0,0 +1,665 @@
+"""
+DataCulture Unified Platform — обработка данных в процессах-воркерах
+Разбор загрузок и расчеты без обращений к Streamlit: модуль импортируется
+как обычный пакет, поэтому его функции сериализуются pickle по имени модуля
+и доступны процессам пула, запущенным через forkserver или spawn.
+Автор: Тимошка
+"""
+
+import io
+import json
+import re
+import functools
+import hashlib
+import threading
+from collections import OrderedDict
+from io import StringIO
+from typing import Dict, Optional
+
+import numpy as np
+import pandas as pd
+
+try:
+    import python_calamine  # noqa: F401 — быстрый движок чтения xlsx (pandas >= 2.2)
+    CALAMINE_AVAILABLE = tuple(int(part) for part in pd.__version__.split('.')[:2]) >= (2, 2)
+except ImportError:
+    CALAMINE_AVAILABLE = False
+
+# =============================================================================
+# РАЗБОР ЗАГРУЖЕННЫХ ФАЙЛОВ
+# =============================================================================
+
+def _read_excel_bytes(content: bytes, usecols=None) -> pd.DataFrame:
+    """Чтение Excel из байтов: calamine, если установлен, иначе движок pandas по умолчанию"""
+    engine = 'calamine' if CALAMINE_AVAILABLE else None
+    return pd.read_excel(io.BytesIO(content), engine=engine, usecols=usecols)
+
+def _read_csv_bytes(content: bytes, usecols=None, detect_encoding: bool = True) -> pd.DataFrame:
+    """Чтение CSV из байтов: UTF-16 с табуляцией (выгрузки LMS), затем UTF-8 и CP1251"""
+    if not detect_encoding:
+        return pd.read_csv(io.BytesIO(content), usecols=usecols)
+    try:
+        return pd.read_csv(StringIO(content.decode('utf-16')), sep='\t', usecols=usecols)
+    except (UnicodeDecodeError, pd.errors.ParserError):
+        try:
+            return pd.read_csv(StringIO(content.decode('utf-8')), usecols=usecols)
+        except UnicodeDecodeError:
+            return pd.read_csv(StringIO(content.decode('cp1251')), usecols=usecols)
+
+def parse_table_bytes(content: bytes, file_name: str, usecols=None, detect_encoding: bool = True) -> pd.DataFrame:
+    """
+    Разбор загруженной таблицы (Excel или CSV) из байтов
+    
+    Args:
+        content: Содержимое файла
+        file_name: Имя файла (по расширению выбирается формат)
+        usecols: Список нужных колонок или функция-фильтр по имени колонки (None — все)
+        detect_encoding: Подбирать ли кодировку CSV (иначе читается как UTF-8)
+        
+    Returns:
+        DataFrame с данными файла
+    """
+    lower_name = file_name.lower()
+    if lower_name.endswith(('.xlsx', '.xls')):
+        return _read_excel_bytes(content, usecols)
+    if lower_name.endswith('.csv'):
+        return _read_csv_bytes(content, usecols, detect_encoding)
+    raise ValueError(f"Неподдерживаемый формат файла: {file_name}")
+
+# =============================================================================
+# МОДУЛЬ 1: ПЕРЕЗАЧЕТ ОЦЕНОК
+# =============================================================================
+
+GRADE_RECALC_REQUIRED_COLUMNS = [
+    'Наименование НЭ', 'Оценка НЭ', 'Оценка дисциплины-пререквизита',
+    'Внешнее измерение цифровых компетенций. Входной контроль',
+    'Внешнее измерение цифровых компетенций. Промежуточный контроль',
+    'Внешнее измерение цифровых компетенций. Итоговый контроль'
+]
+
+# Декларативная таблица правил перезачета.
+# Операнды условий: ne (оценка НЭ), dpr (оценка ДПР после ограничения), innopolis (внешнее
+# измерение текущего этапа), max (максимум из трёх), vhod/prom/itog (этапы внешнего измерения)
+# или число. Правила каждой колонки проверяются сверху вниз, срабатывает первое подходящее;
+# "then": null означает пустую оценку. Пустой список "when" — правило по умолчанию.
+DEFAULT_GRADE_RULES = {
+    "prerequisite_cap": {"min_grade": 9, "value": 8},
+    "dynamics_tolerance": 1,
+    "stages": [
+        {"keyword": "анализу данных", "stage": 3},
+        {"keyword": "программированию", "stage": 2}
+    ],
+    "outputs": {
+        "ДПР_итог": [
+            {"when": [["ne", "<", 4]], "then": None},
+            {"when": [["max", "==", "innopolis"], ["innopolis", ">", 3], ["innopolis", "!=", "dpr"], ["innopolis", "!=", "ne"]], "then": "innopolis"},
+            {"when": [["ne", "==", "dpr"]], "then": None},
+            {"when": [["dpr", "<", 4]], "then": "ne"},
+            {"when": [["max", "==", "dpr"], ["dpr", ">=", 4]], "then": None},
+            {"when": [], "then": "ne"}
+        ],
+        "НЭ_итог": [
+            {"when": [["ne", "<", 4]], "then": None},
+            {"when": [["max", "==", "innopolis"], ["innopolis", ">", 3], ["innopolis", "!=", "dpr"], ["innopolis", "!=", "ne"]], "then": "innopolis"},
+            {"when": [["ne", "==", "dpr"]], "then": None},
+            {"when": [["max", "==", "dpr"], ["dpr", ">=", 4], ["ne", ">=", 8]], "then": None},
+            {"when": [["max", "==", "dpr"], ["dpr", ">=", 4], ["dpr", ">=", 8]], "then": 8},
+            {"when": [["max", "==", "dpr"], ["dpr", ">=", 4]], "then": "dpr"},
+            {"when": [], "then": None}
+        ]
+    }
+}
+
+GRADE_RULE_OPERANDS = ('ne', 'dpr', 'innopolis', 'max', 'vhod', 'prom', 'itog')
+
+GRADE_RULE_COMPARATORS = {
+    '<': np.less,
+    '<=': np.less_equal,
+    '>': np.greater,
+    '>=': np.greater_equal,
+    '==': np.equal,
+    '!=': np.not_equal
+}
+
+def _compile_rule_operand(value, rule_name: str):
+    """Проверяет операнд правила и возвращает имя переменной или число"""
+    if value is None:
+        return np.nan
+    if isinstance(value, str):
+        if value not in GRADE_RULE_OPERANDS:
+            raise ValueError(f"Неизвестный операнд '{value}' в правилах для '{rule_name}'")
+        return value
+    if isinstance(value, bool) or not isinstance(value, (int, float)):
+        raise ValueError(f"Некорректное значение {value!r} в правилах для '{rule_name}'")
+    return float(value)
+
+def compile_grade_rules(rules: dict) -> dict:
+    """
+    Компиляция декларативной таблицы правил перезачета
+    
+    Проверяет таблицу один раз и превращает условия в список сравнений,
+    которые затем вычисляются сразу для всех строк.
+    
+    Args:
+        rules: Таблица правил в формате DEFAULT_GRADE_RULES
+        
+    Returns:
+        Словарь со скомпилированными порогами и правилами по колонкам
+    """
+    if not isinstance(rules, dict):
+        raise ValueError("Правила перезачета должны быть JSON-объектом")
+    try:
+        cap = rules.get("prerequisite_cap") or {}
+        compiled = {
+            'cap_min_grade': float(cap["min_grade"]) if cap else None,
+            'cap_value': float(cap["value"]) if cap else None,
+            'dynamics_tolerance': float(rules.get("dynamics_tolerance", DEFAULT_GRADE_RULES["dynamics_tolerance"])),
+            'stages': [(str(stage["keyword"]), int(stage["stage"])) for stage in rules.get("stages", [])],
+            'outputs': []
+        }
+    except (KeyError, TypeError, ValueError) as e:
+        raise ValueError(f"Некорректные параметры правил перезачета: {e}")
+
+    outputs = rules.get("outputs")
+    if not isinstance(outputs, dict) or not outputs:
+        raise ValueError("В правилах перезачета не задан раздел 'outputs'")
+
+    for output_col, output_rules in outputs.items():
+        if not isinstance(output_rules, list):
+            raise ValueError(f"Правила для '{output_col}' должны быть списком")
+        compiled_rules = []
+        for rule_idx, rule in enumerate(output_rules, start=1):
+            if not isinstance(rule, dict):
+                raise ValueError(f"Правило {rule_idx} для '{output_col}' должно быть объектом с ключами 'when' и 'then'")
+            when = rule.get("when", [])
+            if not isinstance(when, list):
+                raise ValueError(f"Условия правила {rule_idx} для '{output_col}' должны быть списком")
+            conditions = []
+            for condition in when:
+                if not isinstance(condition, (list, tuple)) or len(condition) != 3:
+                    raise ValueError(f"Условие {condition!r} правила {rule_idx} для '{output_col}' должно иметь вид [операнд, оператор, операнд]")
+                left, comparator, right = condition
+                if not isinstance(comparator, str) or comparator not in GRADE_RULE_COMPARATORS:
+                    raise ValueError(f"Неизвестный оператор '{comparator}' в правилах для '{output_col}'")
+                conditions.append((
+                    _compile_rule_operand(left, output_col),
+                    GRADE_RULE_COMPARATORS[comparator],
+                    _compile_rule_operand(right, output_col)
+                ))
+            compiled_rules.append((conditions, _compile_rule_operand(rule.get("then"), output_col)))
+        compiled['outputs'].append((output_col, compiled_rules))
+
+    return compiled
+
+@functools.lru_cache(maxsize=32)
+def _compile_grade_rules_cached(rules_json: str) -> dict:
+    """Кэширует скомпилированные правила по их JSON-представлению"""
+    return compile_grade_rules(json.loads(rules_json))
+
+def load_grade_rules(rules_content: bytes) -> dict:
+    """
+    Загрузка таблицы правил перезачета из JSON-файла
+    
+    Args:
+        rules_content: Содержимое JSON-файла
+        
+    Returns:
+        Проверенная таблица правил
+    """
+    try:
+        rules = json.loads(rules_content.decode('utf-8-sig'))
+    except (UnicodeDecodeError, json.JSONDecodeError) as e:
+        raise ValueError(f"Файл правил не является корректным JSON: {e}")
+    compile_grade_rules(rules)
+    return rules
+
+def _evaluate_rule_operand(operand, variables: Dict[str, np.ndarray]):
+    """Возвращает массив переменной или число как есть"""
+    return variables[operand] if isinstance(operand, str) else operand
+
+def process_grade_recalculation(df: pd.DataFrame, use_dynamics: bool, rules: dict = None) -> pd.DataFrame:
+    """
+    Обработка данных для перезачета оценок (векторизованная версия)
+    
+    Правила берутся из декларативной таблицы (по умолчанию DEFAULT_GRADE_RULES),
+    которая компилируется один раз и вычисляется целиком по столбцам через np.select.
+    
+    Args:
+        df: DataFrame с данными студентов
+        use_dynamics: Учитывать ли динамику оценок
+        rules: Таблица правил перезачета (None — правила по умолчанию)
+        
+    Returns:
+        Обработанный DataFrame с колонками ДПР_итог и НЭ_итог
+    """
+    compiled = _compile_grade_rules_cached(json.dumps(rules or DEFAULT_GRADE_RULES, ensure_ascii=False, sort_keys=True))
+    processed_df = df.copy()
+    
+    for col in GRADE_RECALC_REQUIRED_COLUMNS:
+        if col not in processed_df.columns:
+            raise KeyError(f"Отсутствует обязательный столбец: '{col}'")
+
+    if compiled['cap_min_grade'] is not None:
+        dpr_col = processed_df['Оценка дисциплины-пререквизита']
+        processed_df['Оценка дисциплины-пререквизита'] = dpr_col.mask(dpr_col >= compiled['cap_min_grade'], compiled['cap_value'])
+
+    processed_df['Этап'] = 1
+    for keyword, stage_number in compiled['stages']:
+        processed_df.loc[processed_df['Наименование НЭ'].str.contains(keyword, case=False, na=False, regex=False), 'Этап'] = stage_number
+
+    vhod = processed_df['Внешнее измерение цифровых компетенций. Входной контроль'].to_numpy(dtype=float)
+    prom = processed_df['Внешнее измерение цифровых компетенций. Промежуточный контроль'].to_numpy(dtype=float)
+    itog = processed_df['Внешнее измерение цифровых компетенций. Итоговый контроль'].to_numpy(dtype=float)
+    stage = processed_df['Этап'].to_numpy()
+
+    innopolis = np.select([stage == 1, stage == 2], [vhod, prom], default=itog)
+    ne = np.nan_to_num(processed_df['Оценка НЭ'].to_numpy(dtype=float), nan=0.0)
+    dpr = np.nan_to_num(processed_df['Оценка дисциплины-пререквизита'].to_numpy(dtype=float), nan=0.0)
+    innopolis = np.nan_to_num(innopolis, nan=0.0)
+
+    variables = {
+        'ne': ne,
+        'dpr': dpr,
+        'innopolis': innopolis,
+        'max': np.maximum(np.maximum(ne, dpr), innopolis),
+        'vhod': vhod,
+        'prom': prom,
+        'itog': itog
+    }
+
+    # Сравнения с NaN дают False, как и в построчной версии
+    with np.errstate(invalid='ignore'):
+        if use_dynamics:
+            tolerance = compiled['dynamics_tolerance']
+            blocked = (vhod - prom > tolerance) | (vhod - itog > tolerance) | (prom - itog > tolerance)
+        else:
+            blocked = np.zeros(len(processed_df), dtype=bool)
+
+        for output_col, output_rules in compiled['outputs']:
+            conditions = [blocked]
+            choices = [np.nan]
+            for rule_conditions, outcome in output_rules:
+                mask = np.ones(len(processed_df), dtype=bool)
+                for left, comparator, right in rule_conditions:
+                    mask &= comparator(_evaluate_rule_operand(left, variables), _evaluate_rule_operand(right, variables))
+                conditions.append(mask)
+                choices.append(_evaluate_rule_operand(outcome, variables))
+            processed_df[output_col] = np.select(conditions, choices, default=np.nan)
+    
+    return processed_df
+
+def recalculate_grade_file(file_name: str, content: bytes, use_dynamics: bool, rules: dict = None) -> pd.DataFrame:
+    """Чтение одного файла и перезачет (выполняется в процессе-воркере)"""
+    df = parse_table_bytes(content, file_name, detect_encoding=False)
+    return process_grade_recalculation(df, use_dynamics=use_dynamics, rules=rules)
+
+def process_grade_recalculation_reference(df: pd.DataFrame, use_dynamics: bool) -> pd.DataFrame:
+    """
+    Построчная (эталонная) реализация перезачета оценок.
+    Используется для сверки с векторизованной process_grade_recalculation.
+    
+    Args:
+        df: DataFrame с данными студентов
+        use_dynamics: Учитывать ли динамику оценок
+        
+    Returns:
+        Обработанный DataFrame с колонками ДПР_итог и НЭ_итог
+    """
+    processed_df = df.copy()
+
+    for col in GRADE_RECALC_REQUIRED_COLUMNS:
+        if col not in processed_df.columns:
+            raise KeyError(f"Отсутствует обязательный столбец: '{col}'")
+
+    processed_df['Оценка дисциплины-пререквизита'] = processed_df['Оценка дисциплины-пререквизита'].apply(
+        lambda x: 8 if x >= 9 else x
+    )
+
+    processed_df['Этап'] = 1
+    processed_df.loc[processed_df['Наименование НЭ'].str.contains('анализу данных', case=False, na=False), 'Этап'] = 3
+    processed_df.loc[processed_df['Наименование НЭ'].str.contains('программированию', case=False, na=False), 'Этап'] = 2
+
+    dpr_results = []
+    ie_results = []
+
+    for index, row in processed_df.iterrows():
+        if row['Этап'] == 1:
+            innopolis_grade = row['Внешнее измерение цифровых компетенций. Входной контроль']
+        elif row['Этап'] == 2:
+            innopolis_grade = row['Внешнее измерение цифровых компетенций. Промежуточный контроль']
+        else:
+            innopolis_grade = row['Внешнее измерение цифровых компетенций. Итоговый контроль']
+
+        if use_dynamics:
+            vhod = row['Внешнее измерение цифровых компетенций. Входной контроль']
+            prom = row['Внешнее измерение цифровых компетенций. Промежуточный контроль']
+            itog = row['Внешнее измерение цифровых компетенций. Итоговый контроль']
+            
+            if (vhod - prom > 1) or (vhod - itog > 1) or (prom - itog > 1):
+                dpr_results.append(np.nan)
+                ie_results.append(np.nan)
+                continue
+
+        ne_grade = row['Оценка НЭ']
+        dpr_grade = row['Оценка дисциплины-пререквизита']
+        
+        ne_grade = 0 if pd.isna(ne_grade) else ne_grade
+        dpr_grade = 0 if pd.isna(dpr_grade) else dpr_grade
+        innopolis_grade = 0 if pd.isna(innopolis_grade) else innopolis_grade
+
+        max_grade = max(ne_grade, dpr_grade, innopolis_grade)
+        
+        # Расчет ДПР_итог
+        dpr_final = np.nan
+        if ne_grade < 4:
+            dpr_final = np.nan
+        elif max_grade == innopolis_grade and innopolis_grade > 3 and innopolis_grade != dpr_grade and innopolis_grade != ne_grade:
+            dpr_final = innopolis_grade
+        elif ne_grade == dpr_grade:
+            dpr_final = np.nan
+        elif dpr_grade < 4:
+            dpr_final = ne_grade if ne_grade >= 4 else np.nan
+        elif max_grade == dpr_grade and dpr_grade >= 4:
+            dpr_final = np.nan
+        else:
+            dpr_final = ne_grade
+        dpr_results.append(dpr_final)
+
+        # Расчет НЭ_итог
+        ie_final = np.nan
+        if ne_grade < 4:
+            ie_final = np.nan
+        elif max_grade == innopolis_grade and innopolis_grade > 3 and innopolis_grade != dpr_grade and innopolis_grade != ne_grade:
+            ie_final = innopolis_grade
+        elif ne_grade == dpr_grade:
+            ie_final = np.nan
+        elif max_grade == dpr_grade and dpr_grade >= 4:
+            if ne_grade >= 8:
+                ie_final = np.nan
+            elif dpr_grade >= 8:
+                ie_final = 8
+            else:
+                ie_final = dpr_grade
+        elif ne_grade < 4 and innopolis_grade > 3 and use_dynamics:
+             ie_final = innopolis_grade
+        else:
+            ie_final = np.nan
+        ie_results.append(ie_final)
+
+    processed_df['ДПР_итог'] = dpr_results
+    processed_df['НЭ_итог'] = ie_results
+    
+    return processed_df
+
+def compare_grade_recalculation(df: pd.DataFrame, use_dynamics: bool) -> pd.DataFrame:
+    """
+    Сверка векторизованной и эталонной реализаций перезачета на одних данных
+    
+    Args:
+        df: DataFrame с данными студентов
+        use_dynamics: Учитывать ли динамику оценок
+        
+    Returns:
+        DataFrame со строками, где результаты ДПР_итог/НЭ_итог расходятся (пустой, если совпадают)
+    """
+    fast_df = process_grade_recalculation(df, use_dynamics)
+    reference_df = process_grade_recalculation_reference(df, use_dynamics)
+    
+    mismatch = np.zeros(len(df), dtype=bool)
+    for col in ['ДПР_итог', 'НЭ_итог']:
+        fast_values = fast_df[col].to_numpy(dtype=float)
+        reference_values = reference_df[col].to_numpy(dtype=float)
+        both_nan = np.isnan(fast_values) & np.isnan(reference_values)
+        mismatch |= ~both_nan & (fast_values != reference_values)
+    
+    result = df.loc[mismatch].copy()
+    for col in ['ДПР_итог', 'НЭ_итог']:
+        result[f'{col} (вектор)'] = fast_df.loc[mismatch, col]
+        result[f'{col} (эталон)'] = reference_df.loc[mismatch, col]
+    return result
+
+# =============================================================================
+# МОДУЛЬ 5: АНАЛИТИКА КУРСОВ
+# =============================================================================
+
+CG_EXCLUDED_KEYWORDS = [
+    'take away', 'шпаргалка', 'консультация', 'общая информация', 'промо-ролик',
+    'поддержка студентов', 'пояснение', 'случайный вариант для студентов с овз',
+    'материалы по модулю', 'копия', 'демонстрационный вариант', 'спецификация',
+    'демо-версия', 'правила проведения независимого экзамена',
+    'порядок организации и проведения независимых экзаменов',
+    'интерактивный тренажер правил нэ', 'пересдачи в сентябре', 'незрячих и слабовидящих',
+    'проекты с использование tei', 'тренировочный тест', 'ключевые принципы tei',
+    'базовые возможности tie', 'специальные модули tei', 'будут идентичными',
+    'опрос', 'тест по модулю', 'анкета', 'user information', 'страна', 'user_id', 'данные о пользователе'
+]
+
+# Все ключевые слова исключения ЦГ одним регулярным выражением
+CG_EXCLUDED_PATTERN = re.compile('|'.join(re.escape(keyword.lower()) for keyword in CG_EXCLUDED_KEYWORDS))
+
+# Отметка времени: в значении есть ':' и год вида 20XX (без привязки к списку лет)
+COURSE_TIMESTAMP_PATTERN = re.compile(r'^(?=.*:)(?=.*(?<!\d)20\d{2}(?!\d))', re.DOTALL)
+
+COURSE_SERVICE_COLUMNS = ['Unnamed: 0', 'Данные о пользователе', 'User information', 'Страна']
+
+COURSE_CLASSIFICATION_CACHE_SIZE = 64
+
+# Заполненные значения колонки, по которым она классифицируется
+COURSE_STATUS_SAMPLE_ROWS = 100
+COURSE_TIMESTAMP_SAMPLE_ROWS = 20
+
+def _course_cell_text(series: pd.Series) -> pd.Series:
+    """Текст ячеек как str(value).strip(); пропуски — пустая строка"""
+    if pd.api.types.is_datetime64_any_dtype(series):
+        # Series.astype(str) отбрасывает время у дат в полночь, str(Timestamp) — нет
+        text = series.dt.strftime('%Y-%m-%d %H:%M:%S')
+    else:
+        text = series.astype(str)
+    return text.str.strip().where(series.notna(), '')
+
+def _completion_from_timestamps(df: pd.DataFrame, timestamp_columns: list) -> np.ndarray:
+    """Процент заданий с отметкой времени выполнения (матрица по всем колонкам сразу)"""
+    done = np.zeros((len(df), len(timestamp_columns)), dtype=bool)
+    for idx, col in enumerate(timestamp_columns):
+        done[:, idx] = _course_cell_text(df[col]).str.contains(COURSE_TIMESTAMP_PATTERN).to_numpy()
+    return done.sum(axis=1) / len(timestamp_columns) * 100
+
+def _completion_from_statuses(df: pd.DataFrame, completed_columns: list) -> np.ndarray:
+    """Процент заданий со статусом "Выполнено" среди заполненных ячеек"""
+    filled = np.zeros((len(df), len(completed_columns)), dtype=bool)
+    done = np.zeros((len(df), len(completed_columns)), dtype=bool)
+    for idx, col in enumerate(completed_columns):
+        text = _course_cell_text(df[col])
+        filled[:, idx] = ((text != '') & (text != 'nan')).to_numpy()
+        done[:, idx] = filled[:, idx] & text.str.lower().str.contains('выполнено', regex=False).to_numpy()
+    total_tasks = filled.sum(axis=1)
+    completed_tasks = done.sum(axis=1)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return np.where(total_tasks > 0, completed_tasks / total_tasks * 100, 0.0)
+
+# Кэш классификации колонок по сигнатуре выгрузки: общий для потоков процесса
+_course_classification_cache = OrderedDict()
+_course_classification_lock = threading.Lock()
+
+def _first_filled(series: pd.Series, count: int) -> pd.Series:
+    """Первые count заполненных значений (как series.dropna().head(count), без копии колонки)"""
+    return series.iloc[np.flatnonzero(series.notna().to_numpy())[:count]]
+
+def _course_column_samples(df: pd.DataFrame, course_name: str, email_column: str):
+    """
+    Выборки колонок, по которым они классифицируются
+    
+    Для колонок заданий — первые COURSE_STATUS_SAMPLE_ROWS заполненных значений,
+    для колонок "Unnamed:" — текст первых COURSE_TIMESTAMP_SAMPLE_ROWS заполненных.
+    
+    Returns:
+        Tuple (список (колонка, вид 'status' или 'timestamp', выборка), число исключенных колонок ЦГ)
+    """
+    samples = []
+    excluded_count = 0
+    for col in df.columns:
+        col_name = str(col)
+        if col_name in COURSE_SERVICE_COLUMNS or col == email_column:
+            continue
+        if course_name == 'ЦГ' and CG_EXCLUDED_PATTERN.search(col_name.strip().lower()):
+            excluded_count += 1
+            continue
+
+        if not col_name.startswith('Unnamed:') and len(col_name.strip()) > 0:
+            samples.append((col, 'status', _first_filled(df[col], COURSE_STATUS_SAMPLE_ROWS).astype(str)))
+        elif col_name.startswith('Unnamed:'):
+            samples.append((col, 'timestamp', _course_cell_text(_first_filled(df[col], COURSE_TIMESTAMP_SAMPLE_ROWS))))
+    return samples, excluded_count
+
+def _course_samples_signature(samples: list, course_name: str, email_column: str) -> tuple:
+    """
+    Сигнатура выгрузки: курс, колонка email и хеш выборок классификатора
+    
+    Классификация зависит только от этих выборок, поэтому одинаковая сигнатура
+    означает одинаковый результат.
+    """
+    digest = hashlib.sha1()
+    for col, kind, sample in samples:
+        digest.update(f"{col!r}\x1e{kind}\x1e{len(sample)}\x1e".encode('utf-8'))
+        digest.update('\x1f'.join(sample.tolist()).encode('utf-8'))
+        digest.update(b'\x1d')
+    return course_name, email_column, digest.hexdigest()
+
+def classify_course_columns(df: pd.DataFrame, course_name: str, email_column: str) -> Dict[str, list]:
+    """
+    Классификация колонок выгрузки курса: статусы выполнения и отметки времени
+    
+    Результат запоминается по хешу выборок, которые читает классификатор
+    (_course_column_samples), поэтому повторная выгрузка с теми же данными в
+    выборках не классифицируется заново.
+    
+    Args:
+        df: DataFrame с выгрузкой курса
+        course_name: Название курса
+        email_column: Колонка с email
+        
+    Returns:
+        Словарь с completed_columns, timestamp_columns и excluded_count
+    """
+    samples, excluded_count = _course_column_samples(df, course_name, email_column)
+    signature = _course_samples_signature(samples, course_name, email_column)
+    with _course_classification_lock:
+        cached = _course_classification_cache.get(signature)
+        if cached is not None:
+            _course_classification_cache.move_to_end(signature)
+            return cached
+
+    completed_columns = []
+    timestamp_columns = []
+    for col, kind, sample_values in samples:
+        if kind == 'status':
+            if sample_values.str.lower().str.contains('выполнено', regex=False).any():
+                if not (sample_values == 'Не выполнено').all():
+                    completed_columns.append(col)
+        elif sample_values.str.contains(COURSE_TIMESTAMP_PATTERN).any():
+            timestamp_columns.append(col)
+
+    classification = {
+        'completed_columns': completed_columns,
+        'timestamp_columns': timestamp_columns,
+        'excluded_count': excluded_count
+    }
+    with _course_classification_lock:
+        _course_classification_cache[signature] = classification
+        while len(_course_classification_cache) > COURSE_CLASSIFICATION_CACHE_SIZE:
+            _course_classification_cache.popitem(last=False)
+    return classification
+
+COURSE_EMAIL_COLUMNS = ['Адрес электронной почты', 'Корпоративная почта', 'Email', 'Почта', 'E-mail']
+
+def compute_course_completion(df: pd.DataFrame, course_name: str, report) -> Optional[pd.DataFrame]:
+    """
+    Расчет процента завершения курса по разобранной выгрузке
+    
+    Args:
+        df: DataFrame с выгрузкой курса
+        course_name: Название курса
+        report: Функция вывода сообщений (level, message)
+        
+    Returns:
+        DataFrame с колонками "Корпоративная почта" и "Процент_<курс>" или None
+    """
+    email_column = None
+    for col_name in COURSE_EMAIL_COLUMNS:
+        if col_name in df.columns:
+            email_column = col_name
+            break
+    if email_column is None:
+        report('error', f"Столбец с email не найден в файле {course_name}")
+        return None
+
+    classification = classify_course_columns(df, course_name, email_column)
+    completed_columns = classification['completed_columns']
+    timestamp_columns = classification['timestamp_columns']
+
+    if timestamp_columns or completed_columns:
+        email_values = df[email_column]
+        valid_emails = email_values.notna() & email_values.astype(str).str.lower().str.contains('@edu.hse.ru', regex=False)
+        students_df = df.loc[valid_emails]
+
+        if timestamp_columns:
+            percentages = _completion_from_timestamps(students_df, timestamp_columns)
+        else:
+            percentages = _completion_from_statuses(students_df, completed_columns)
+
+        if len(students_df) > 0:
+            result_df = pd.DataFrame({
+                'Корпоративная почта': students_df[email_column].astype(str).str.lower().str.strip().to_numpy(),
+                f'Процент_{course_name}': percentages
+            })
+            report('success', f"✅ Рассчитан процент завершения для {len(result_df)} студентов курса {course_name}")
+            return result_df
+
+    report('warning', f"Не найдено данных о завершении для курса {course_name}")
+    return None
+
+def extract_course_worker(file_name: str, content: bytes, course_name: str):
+    """
+    Разбор и расчет одного курса (выполняется в процессе-воркере)
+    
+    Returns:
+        Tuple (результат или None, список сообщений (level, message))
+    """
+    messages = []
+    
+    def report(level, message):
+        messages.append((level, message))
+    
+    try:
+        if not file_name.lower().endswith(('.xlsx', '.xls', '.csv')):
+            report('error', f"Неподдерживаемый формат файла для курса {course_name}")
+            return None, messages
+        result_df = compute_course_completion(parse_table_bytes(content, file_name), course_name, report)
+    except Exception as e:
+        report('error', f"Ошибка обработки данных курса {course_name}: {e}")
+        return None, messages
+    return result_df, messages
+
+def _grade_self_check_frame(rows: int, seed: int = 0) -> pd.DataFrame:
+    """Случайные данные перезачета: все этапы, оценки 0–10 и пропуски"""
+    rng = np.random.default_rng(seed)
+
+    def grades():
+        values = rng.integers(0, 11, rows).astype(float)
+        values[rng.random(rows) < 0.1] = np.nan
+        return values
+
+    data = {'Наименование НЭ': rng.choice(
+        ['НЭ по анализу данных', 'НЭ по программированию', 'НЭ по цифровой грамотности', None], rows
+    )}
+    for col in GRADE_RECALC_REQUIRED_COLUMNS[1:]:
+        data[col] = grades()
+    return pd.DataFrame(data)
+
+if __name__ == "__main__":
+    # Самопроверка: python processing.py — векторизованный перезачет совпадает с эталонным
+    check_df = _grade_self_check_frame(20000)
+    for check_dynamics in (False, True):
+        mismatches = compare_grade_recalculation(check_df, check_dynamics)
+        assert mismatches.empty, f"Расхождения с эталоном (динамика={check_dynamics}):\n{mismatches.head()}"
+    print(f"OK: перезачет совпадает с эталоном на {len(check_df)} строках (с динамикой и без)")